@@ -3,25 +3,34 @@ import os
 import signal
 import time
 import threading
+import asyncio
 import traceback
 import json
 import bcrypt
-from contextlib import closing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import smbio
 import database
+import codes
 from config import Config
 
 
 class AlarmManager:
 
     def __init__(self):
-        self.alarm = Alarm()
+        if Config["engine"] == "asyncio":
+            self.alarm = AsyncAlarm()
+        elif Config["engine"] == "thread":
+            self.alarm = Alarm()
+        else:
+            raise ValueError("unknown engine: {}".format(Config["engine"]))
         self._running = False
         self.COMMANDS = {
             "start": self.start_alarm,
             "stop": self.stop_alarm,
             "restart": self.restart_alarm,
-            "action": self.action_alarm}
+            "action": self.action_alarm,
+            "trace": self.trace_alarm}
 
     def start_alarm(self, reason):
         self.alarm.start()
@@ -36,9 +45,13 @@ class AlarmManager:
         self.log("Alarm thread restart command sent: " + reason)
 
     def action_alarm(self, data):
-        self.alarm.process_command(data["command"], data["reason"])
+        self.alarm.submit_command(data["command"], data["reason"])
         self.log("Alarm thread action command sent")
 
+    def trace_alarm(self, command):
+        self.alarm.trace(command)
+        self.log("Bus trace command sent: " + command)
+
     def log(self, message, error=None):
         timestamp = time.strftime("%Z %Y-%m-%d %H:%M:%S", time.localtime())
         if error:
@@ -67,10 +80,10 @@ class AlarmManager:
         if Config["auto_start"]:
             self.start_alarm("Auto Start")
             if Config["auto_arm"]:
-                self.alarm.arm("Auto Arm")
+                self.alarm.submit_command("arm", "Auto Arm")
         while self._running:
             try:
-                with closing(database.get_db()) as db:
+                with database.connection() as db:
                     c = db.cursor()
                     c.execute("select cmd_id, data from cmdq;")
                     cmds = c.fetchall()
@@ -88,6 +101,7 @@ class AlarmManager:
                 self.stop_alarm("Recivecd Ctl-C")
                 self._running = False
         self.log_state()
+        database.flush_log()
 
     def process_cmd(self, cmd_id, data):
         self.clear_cmd(cmd_id)
@@ -100,13 +114,13 @@ class AlarmManager:
             raise ValueError("Bad manager cmd data '%r'" % (data,))
 
     def clear_cmd(self, cmd_id):
-        with closing(database.get_db()) as db:
+        with database.connection() as db:
             c = db.cursor()
             c.execute("delete from cmdq where cmd_id = %s" % (cmd_id,))
             db.commit()
 
     def log_state(self):
-        with closing(database.get_db()) as db:
+        with database.connection() as db:
             c = db.cursor()
             c.execute(
                 "INSERT OR IGNORE INTO state (key) VALUES ('alarm_thread');")
@@ -118,6 +132,44 @@ class AlarmManager:
                 {
                     "data": json.dumps(self.alarm.is_running()),
                     "time": time.time()})
+            c.execute(
+                "INSERT OR IGNORE INTO state (key) VALUES ('alarm_loop');")
+            c.execute(
+                "UPDATE state SET "
+                "data = :data, "
+                "state_time = :time "
+                "WHERE key = 'alarm_loop';",
+                {
+                    "data": json.dumps(self.alarm.loop_report()),
+                    "time": time.time()})
+            if any(bus.enabled for bus in self.alarm.traces.values()):
+                c.execute(
+                    "INSERT OR IGNORE INTO state (key) "
+                    "VALUES ('bus_trace');")
+                c.execute(
+                    "UPDATE state SET "
+                    "data = :data, "
+                    "state_time = :time "
+                    "WHERE key = 'bus_trace';",
+                    {
+                        "data": json.dumps({
+                            bus: traced.report()
+                            for bus, traced in self.alarm.traces.items()}),
+                        "time": time.time()})
+            if Config["bus_scheduler"]:
+                c.execute(
+                    "INSERT OR IGNORE INTO state (key) "
+                    "VALUES ('bus_scheduler');")
+                c.execute(
+                    "UPDATE state SET "
+                    "data = :data, "
+                    "state_time = :time "
+                    "WHERE key = 'bus_scheduler';",
+                    {
+                        "data": json.dumps({
+                            bus: scheduler.report()
+                            for bus, scheduler in self.alarm.buses.items()}),
+                        "time": time.time()})
 
             db.commit()
 
@@ -163,14 +215,50 @@ class Alarm:
         self.ACTIONS["alarm"] = self.alarm
 
         self.state = 0
-        self.last = time.time()
+        self.last = time.monotonic()
         self.armtime = 0
 
+        self.int_line = None
+        self.latched = False
+        self.waker = smbio.timer.Waker()
+        self.acquirer = None
+        self.acquired = {}
+        self.acquiring = False
+        self.acquire_failures = 0
+        self.acquire_retry = 0
+        self.ticks = 0
+        self.tick_cpu = 0.0
+        self.loop_mark = (time.monotonic(), 0, 0.0)
+
         self.buses = {}
+        self.traces = {}
         self.ios = {}
+        self.io_signatures = {}
         self.interfaces = {}
+        self.interface_ios = {}
+        self.edge_index = []
+        self.edge_state = None
+        self.polled = []
+        self.outputs = []
+        self.subscribers = {}
+        self.io_priority = {}
+        self.persisted = {}  # state key: json last written
+        self.persisted_at = 0
+        self.persisted_state = None
+        self.timers = smbio.timer.Timers()
+        self.states = {}
         self.indicators = {}
+        self.state_indicators = {}
+        self.last_state = None
         self.actions = {}
+        self.code_key = None
+        self.action_tags = {}  # code tag: actions with that tag
+        self.untagged = []  # actions stored before code tags
+        self.verify_pool = ThreadPoolExecutor(
+            Config["verify_workers"], "alarm-verify")
+        self.verifying = {}  # interface id: codes queued behind a check
+        self.verified = deque()  # finished checks, appended by the pool
+        self.verify_stats = (0, 0.0, 0.0)  # count, total, max seconds
 
     def is_running(self):
         if self.thread is not None:
@@ -182,7 +270,7 @@ class Alarm:
             return
         if self.state == self.DISARMED:
             self.state = self.ARMDELAY
-            self.armtime = time.time()
+            self.armtime = time.monotonic()
         self.log("ARM " + reason)
 
     def disarm(self, reason):
@@ -196,60 +284,149 @@ class Alarm:
             return
         if self.state == Alarm.ARMED:
             self.state = Alarm.TRIPPED
-            self.last = time.time()
+            self.last = time.monotonic()
             self.log("TRIPPED " + reason)
         elif self.state == Alarm.DISARMED:
             self.state = Alarm.FAULT
             self.log("FAULTED " + reason)
-            self.last = time.time()
+            self.last = time.monotonic()
 
     def alarm(self, reason):
         self.state = Alarm.ALARMED
         self.log("ALARM " + reason, alarm=True)
 
     def update_state(self):
-        for key in self.indicators:
-            indicator = self.indicators[key]
-            self.interfaces[indicator["interface"]].update_state(
-                indicator["state"] == self.state)
+        '''
+        on a state change switch off the indicators of the old state
+        and on those of the new one, the first call after configure
+        sets every indicator. returns True if the state changed
+        '''
+        state = self.state  # commands may change it from another thread
+        if state == self.last_state:
+            return False
+        if self.last_state is None:
+            for key in self.indicators:
+                indicator = self.indicators[key]
+                self.interfaces[indicator["interface"]].update_state(
+                    indicator["state"] == state)
+        else:
+            for interface in self.state_indicators.get(self.last_state, ()):
+                interface.update_state(False)
+            for interface in self.state_indicators.get(state, ()):
+                interface.update_state(True)
+        self.last_state = state
+        return True
 
     def update_tripped(self):
-        now = time.time()
+        now = time.monotonic()
         if now - self.last > Config["tripped_timeout"]:
             self.alarm("Tripped timeout")
 
     def update_faulted(self):
-        now = time.time()
+        now = time.monotonic()
         if now - self.last > Config["faulted_timeout"]:
             self.state = Alarm.DISARMED
 
     def update_armdelay(self):
-        now = time.time()
+        now = time.monotonic()
         if now - self.armtime > Config["arm_delay"]:
             self.state = Alarm.ARMED
 
-    def configure(self):
-        with closing(database.get_db()) as db:
+    def configure(self, warm=False):
+        '''
+        build the devices and interfaces from the database,
+        a warm configure keeps every device whose io row and interfaces
+        are unchanged along with its register shadows
+        '''
+        with database.connection() as db:
             c = db.cursor()
-            self._configure_ios(c)
+            self._configure_ios(c, warm)
             self._configure_interfaces(c)
+            self._configure_dispatch()
+            self._configure_acquisition()
             self._configure_actions(c)
             self._configure_indicators(c)
+            self._configure_interrupts()
+            self.flush_devices()
             self._configured = True
 
-    def _configure_ios(self, c):
+    def _io_signatures(self, c, ios):
+            c.execute(
+                "select io_id, interface_id, type, slot, data "
+                "from interface order by interface_id;")
+            interfaces = {}
+            for row in c.fetchall():
+                interfaces.setdefault(row[0], []).append(row[1:])
+            return {
+                io[0]: (io[1:], interfaces.get(io[0], []))
+                for io in ios}
+
+    def _configure_ios(self, c, warm=False):
             c.execute("select io_id, type, bus, addr from io;")
             ios = c.fetchall()
             if ios:
+                old = self.ios or {}
+                old_signatures = self.io_signatures
+                self.io_signatures = self._io_signatures(c, ios)
                 self.ios = {}
+                if warm:
+                    for io_id in list(old):
+                        if old_signatures.get(io_id) == (
+                                self.io_signatures.get(io_id)):
+                            self.ios[io_id] = old.pop(io_id)
+                for io_id, io in old.items():
+                    # changed or removed, release its outputs before a
+                    # replacement at the same address reads its shadows
+                    try:
+                        io.reset()
+                    except OSError as err:
+                        self.log(
+                            "Error resetting device %s" % (io_id,),
+                            error=err)
                 for io in ios:
                     io_id, t, bus, addr, = io
                     if t not in smbio.IOTYPES:
                         raise ValueError("invaid io type for io %s" % (io_id,))
+                    if io_id in self.ios:
+                        continue
                     if bus not in self.buses:
-                        self.buses[bus] = smbio.smb.Bus(bus)
+                        self.traces[bus] = smbio.trace.TracedBus(
+                            smbio.smb.Bus(bus, Config["bus_backend"]), bus)
+                        if Config["bus_trace"]:
+                            self.traces[bus].enable()
+                        self.buses[bus] = self.traces[bus]
+                        if Config["bus_scheduler"]:
+                            self.buses[bus] = smbio.scheduler.Scheduler(
+                                self.buses[bus])
+                    if Config["bus_backend"] == "sim":
+                        if addr not in self.buses[bus].devices:
+                            self.buses[bus].attach(
+                                addr, smbio.SIMMAP[smbio.IOTYPES[t]]())
                     klass = smbio.IOMAP[smbio.IOTYPES[t]]
-                    self.ios[io_id] = klass.create(self.buses[bus], addr)
+                    try:
+                        self.ios[io_id] = klass.create(self.buses[bus], addr)
+                        offline = False
+                    except OSError as err:
+                        # built on the power on values, probe restores it
+                        self.log(
+                            "Device %s at %s is not answering" % (
+                                io_id, hex(addr)),
+                            error=err)
+                        self.ios[io_id] = klass.create(
+                            self.buses[bus], addr, read=False)
+                        offline = True
+                    self.ios[io_id].set_deferred(True)
+                    self.ios[io_id].set_health(
+                        Config["io_fail_threshold"],
+                        Config["io_backoff"],
+                        Config["io_backoff_max"])
+                    self.ios[io_id].set_verify(
+                        smbio.smb.IO.VERIFY[Config["io_verify"]],
+                        Config["io_verify_every"])
+                    if offline:
+                        self.ios[io_id].degrade(time.monotonic())
+                        self.trip("Device {} {} degraded".format(
+                            io_id, self.ios[io_id].name))
 
     def _configure_interfaces(self, c):
             c.execute(
@@ -257,7 +434,9 @@ class Alarm:
                 "from interface;")
             interfaces = c.fetchall()
             if interfaces:
+                self.timers.clear()
                 self.interfaces = {}
+                self.interface_ios = {}
                 for interface in interfaces:
                     interface_id, t, io_id, slot, data_s = interface
                     if t not in smbio.INTERFACETYPES:
@@ -268,21 +447,146 @@ class Alarm:
                     klass = smbio.INTERFACEMAP[
                         smbio.INTERFACETYPES[t]]
                     self.interfaces[interface_id] = klass(
-                        interface_id, self.ios[io_id][slot], data)
+                        interface_id, self.ios[io_id][slot], data,
+                        self.timers)
+                    self.interface_ios[interface_id] = io_id
+
+    def _configure_dispatch(self):
+            '''
+            index edge interfaces by the pin they watch and every
+            interface by the message topics it subscribes to,
+            outputs are driven by state, messages and timers,
+            everything else is polled every tick, a device is flushed
+            at the highest priority of the interfaces on it
+            '''
+            pins = {}
+            self.io_priority = {}
+            self.polled = []
+            self.outputs = []
+            self.subscribers = {}
+            self.states = {}
+            for key, interface in self.interfaces.items():
+                self.states[key] = interface.get_state()
+                io_id = self.interface_ios[key]
+                self.io_priority[io_id] = min(
+                    interface.PRIORITY,
+                    self.io_priority.get(io_id, interface.PRIORITY))
+                for topic in interface.SUBSCRIBES:
+                    self.subscribers.setdefault(topic, []).append(interface)
+                if interface.EDGE:
+                    index = pins.setdefault((io_id, id(interface.io)), (
+                        io_id, interface.io, {}))
+                    index[2].setdefault(interface.pin, []).append(interface)
+                elif interface.POLL:
+                    self.polled.append((key, interface))
+                else:
+                    self.outputs.append((key, interface))
+            self.edge_index = list(pins.values())
+            self.edge_state = None
+            self.persisted = {}
+
+    def _configure_acquisition(self):
+            '''
+            hand the sampling of groups holding only edge inputs and
+            outputs to the acquisition process, keypads stay here
+            since their scan has to see the columns it writes
+            '''
+            specs = []
+            acquired = {}
+            if Config["acquire_process"]:
+                if Config["bus_backend"] == "sim":
+                    raise ValueError(
+                        "the acquisition process can not share a sim bus")
+                io_interfaces = {}
+                for key, io_id in self.interface_ios.items():
+                    io_interfaces.setdefault(io_id, []).append(
+                        self.interfaces[key])
+                for io_id, io in sorted(self.ios.items()):
+                    interfaces = io_interfaces.get(io_id, [])
+                    if any(i.EDGE for i in interfaces) and all(
+                            i.EDGE or not i.POLL for i in interfaces):
+                        acquired[io_id] = len(specs)
+                        specs.append((
+                            self.io_signatures[io_id][0][1],
+                            io.addr,
+                            io.gpio_reads()))
+            for io_id, io in self.ios.items():
+                # debounce windows are set in milliseconds
+                io.set_sample_interval(
+                    Config["acquire_period"] if io_id in acquired
+                    else Config["sample_period"])
+            if self.acquirer is not None:
+                if self.acquirer.specs == specs and self.acquirer.alive():
+                    self.acquired = acquired
+                    return
+                self.acquirer.close()
+                self.acquirer = None
+            if specs:
+                self.acquirer = smbio.acquire.Acquirer(
+                    specs,
+                    Config["bus_backend"],
+                    Config["acquire_period"],
+                    Config["acquire_slots"],
+                    Config["acquire_timeout"])
+            self.acquired = acquired
 
     def _configure_actions(self, c):
             c.execute(
-                "select action_id, code_hash, command, reason "
+                "select action_id, code_hash, code_tag, command, reason "
                 "from action;")
             actions = c.fetchall()
             if actions:
                 self.actions = {}
                 for action in actions:
-                    action_id, code_hash, command, reason = action
+                    action_id, code_hash, code_tag, command, reason = action
                     self.actions[action_id] = {
+                        "action_id": action_id,
                         "code_hash": code_hash,
+                        "code_tag": code_tag,
                         "command": command,
                         "reason": reason}
+            try:
+                self.code_key = codes.load_key()
+            except (OSError, ValueError) as err:
+                self.log("Error loading the code key, "
+                         "every code is checked against every action",
+                         error=err)
+                self.code_key = None
+            if self.code_key is not None:
+                self._check_code_key(c)
+            self.action_tags = {}
+            self.untagged = []
+            for action in self.actions.values():
+                if action["code_tag"] is None or self.code_key is None:
+                    self.untagged.append(action)
+                else:
+                    self.action_tags.setdefault(
+                        action["code_tag"], []).append(action)
+
+    def _check_code_key(self, c):
+            '''
+            tags made with another key never match, when the key changed
+            drop them so every action is checked with bcrypt and retagged
+            '''
+            fingerprint = codes.key_fingerprint(self.code_key)
+            c.execute("select data from state where key = 'code_key';")
+            row = c.fetchone()
+            stored = json.loads(row[0]) if row and row[0] else None
+            if stored == fingerprint:
+                return
+            if stored is not None:
+                self.log("Code key file %s does not match the stored code "
+                         "tags, every action is retagged as its code is "
+                         "used" % (Config["code_key_file"],),
+                         error=True)
+                c.execute("update action set code_tag = null;")
+                for action in self.actions.values():
+                    action["code_tag"] = None
+            c.execute(
+                "INSERT OR REPLACE INTO state (key, data, state_time) "
+                "VALUES ('code_key', :data, :time);",
+                {"data": json.dumps(fingerprint), "time": time.time()})
+            c.connection.commit()
 
     def _configure_indicators(self, c):
             c.execute(
@@ -295,49 +599,97 @@ class Alarm:
                     self.indicators[indicator_id] = {
                         "interface": interface_id,
                         "state": state}
+            self.state_indicators = {}
+            for indicator in self.indicators.values():
+                self.state_indicators.setdefault(
+                    indicator["state"], []).append(
+                        self.interfaces[indicator["interface"]])
+            self.last_state = None
+
+    def _configure_interrupts(self):
+            if not Config["interrupt_mode"]:
+                return
+            for io_id, io in self.ios.items():
+                if not (io.interrupts or io.degraded):
+                    try:
+                        io.enable_interrupts(Config["interrupt_open_drain"])
+                    except OSError as err:
+                        self.io_failed(io_id, err)
+            if self.int_line is None:
+                if Config["bus_backend"] == "sim":
+                    self.int_line = smbio.sim.SimLine(self.buses.values())
+                else:
+                    self.int_line = smbio.gpio.EventLine(
+                        Config["interrupt_chip"], Config["interrupt_line"])
 
     def log(self, message, error=None, alarm=False):
+        database.write_log(
+            self.format_log(message, error),
+            error=(error is not None), alarm=alarm)
+
+    def format_log(self, message, error=None):
+        '''error is the exception being handled or True for no traceback'''
         timestamp = time.strftime("%Z %Y-%m-%d %H:%M:%S", time.localtime())
-        if error:
+        if isinstance(error, BaseException):
             trace = traceback.format_exc()
             message += "\n" + trace
-        message = timestamp + " " + message
-        database.write_log(message, error=(error is not None), alarm=alarm)
+        return timestamp + " " + message
 
     def log_state(self, states):
-        with closing(database.get_db()) as db:
-            c = db.cursor()
-            time_now = time.time()
-            states["alarm"] = self.state
-            for state, data in states.items():
-                c.execute(
-                    "INSERT OR IGNORE INTO state (key) VALUES (:key);",
-                    {"key":  state})
-                c.execute(
-                    "UPDATE state SET "
-                    "data = :data, "
-                    "state_time = :time "
-                    "WHERE key = :key;",
-                    {
-                        "key":  state,
-                        "data": json.dumps(data),
-                        "time": time_now})
+        '''
+        write the states that changed since the last write in one
+        transaction, at most once every state_flush_interval seconds
+        unless the alarm state itself changed
+        '''
+        now = time.monotonic()
+        states["alarm"] = self.state
+        if self.state == self.persisted_state and (
+                now - self.persisted_at < Config["state_flush_interval"]):
+            return
+        self.persisted_at = now
+        self.persisted_state = self.state
+        time_now = time.time()
+        rows = []
+        for state, data in states.items():
+            data_s = json.dumps(data)
+            if self.persisted.get(state) != data_s:
+                rows.append({"key": state, "data": data_s, "time": time_now})
+        if not rows:
+            return
+        with database.connection() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO state (key, data, state_time) "
+                "VALUES (:key, :data, :time);",
+                rows)
             db.commit()
+        for row in rows:
+            self.persisted[row["key"]] = row["data"]
 
     def stop(self):
         if self._running:
             if self.thread is not None:
                 self._running = False
+                self.wakeup()
                 self.thread.join()
+            if self.acquirer is not None:
+                self.acquirer.close()
+                self.acquirer = None
+                self.acquired = {}
             if self.ios is not None:
-                for io in self.ios.values():
-                    io.reset()
+                for io_id, io in self.ios.items():
+                    try:
+                        io.reset()
+                    except OSError as err:
+                        self.log(
+                            "Error resetting device %s" % (io_id,),
+                            error=err)
             del self.thread
             del self.ios
             del self.interfaces
             self.thread = None
             self._configured = False
             self.ios = None
+            self.io_signatures = {}
             self.interfaces = None
 
     def start(self):
@@ -348,9 +700,28 @@ class Alarm:
                 self.configure()
                 self.thread.start()
 
+    def halt(self):
+        '''stop the main loop thread leaving the devices as they are'''
+        if self.thread is not None:
+            self._running = False
+            self.wakeup()
+            self.thread.join()
+            self.thread = None
+
     def restart(self):
-        self.stop()
-        self.start()
+        '''
+        warm restart, bus handles and unchanged devices are kept
+        so their outputs do not glitch and nothing is read back
+        '''
+        started = time.monotonic()
+        self.halt()
+        self._configured = False
+        self.thread = threading.Thread(target=self.run)
+        self._running = True
+        self.configure(warm=True)
+        self.thread.start()
+        self.log("Alarm restarted in %.1f ms" % (
+            (time.monotonic() - started) * 1000,))
 
     def run(self):
         try:
@@ -365,29 +736,269 @@ class Alarm:
             self.log("Error running alarm main thread", error=err)
         self._running = False
 
+    def io_failed(self, io_id, err):
+        io = self.ios[io_id]
+        if io.failed(time.monotonic()):
+            self.log(
+                "Device %s %s at %s degraded after %s failures: %s" % (
+                    io_id, io.name, hex(io.addr), io.failures, err),
+                error=err)
+            self.trip("Device {} {} degraded".format(io_id, io.name))
+
+    def io_recovered(self, io_id):
+        io = self.ios[io_id]
+        if io.recovered():
+            self.log("Device %s %s at %s recovered" % (
+                io_id, io.name, hex(io.addr)))
+
+    def update_devices(self):
+        now = time.monotonic()
+        for io_id, io in self.ios.items():
+            if io.retry_due(now):
+                try:
+                    io.probe()
+                except OSError as err:
+                    self.io_failed(io_id, err)
+                    continue
+                self.io_recovered(io_id)
+            if io.degraded:
+                continue
+            try:
+                if self.interrupt_mode() and not io.interrupts:
+                    # missed at configure while the device was down
+                    io.enable_interrupts(Config["interrupt_open_drain"])
+                with smbio.scheduler.priority(smbio.scheduler.SENSOR):
+                    if self.acquiring and io_id in self.acquired:
+                        # snapshots left over, tick again to take them
+                        if self.acquirer.sample(self.acquired[io_id], io):
+                            self.latched = True
+                    elif io.sample():
+                        self.latched = True
+                io.poll_verify()
+            except OSError as err:
+                self.io_failed(io_id, err)
+                continue
+            self.io_recovered(io_id)
+
+    def check_acquirer(self):
+        '''
+        sets acquiring when the acquisition process serves fresh
+        snapshots, a dead or stalled process is restarted with the
+        device backoff and its groups are sampled here meanwhile
+        '''
+        self.acquiring = False
+        acquirer = self.acquirer
+        if acquirer is None:
+            return
+        newest = acquirer.ring.newest()
+        if not acquirer.stale(newest):
+            if newest:
+                self.acquiring = True
+                self.acquire_failures = 0
+            return
+        now = time.monotonic()
+        if now < self.acquire_retry:
+            return
+        exponent = min(self.acquire_failures, 32)
+        self.acquire_retry = now + min(
+            Config["io_backoff"] * 2 ** exponent, Config["io_backoff_max"])
+        self.acquire_failures += 1
+        self.log("Acquisition process %s, restarting it" % (
+            "stalled" if acquirer.alive() else "died",))
+        acquirer.close()
+        self.acquirer = smbio.acquire.Acquirer(
+            acquirer.specs,
+            Config["bus_backend"],
+            Config["acquire_period"],
+            Config["acquire_slots"],
+            Config["acquire_timeout"])
+
+    def flush_devices(self):
+        '''
+        queue the dirty registers of every device, with the bus scheduler
+        the writes are posted so the next samples can overtake them
+        '''
+        for io_id, io in self.ios.items():
+            if io.degraded:
+                continue
+            level = self.io_priority.get(io_id, smbio.scheduler.COSMETIC)
+            try:
+                with smbio.scheduler.priority(level):
+                    with smbio.scheduler.posting():
+                        io.flush()
+            except OSError as err:
+                self.io_failed(io_id, err)
+
     def update(self):
+        self.latched = False
+        self.check_acquirer()
+        self.update_devices()
+        self.tick()
+        self.flush_devices()
+        self.log_state(self.current_states())
+
+    def tick(self):
+        '''run one pass of the alarm logic on the sampled ports'''
+        self.process_verified()
         if self.state == Alarm.ARMDELAY:
             self.update_armdelay()
         elif self.state == Alarm.TRIPPED:
             self.update_tripped()
         elif self.state == Alarm.FAULT:
             self.update_faulted()
-        self.update_state()
-        states = {}
-        for key in self.interfaces:
-            interface = self.interfaces[key]
-            self.process_interface(interface, interface.update())
-            self.process_messages(interface.pull_messages())
+        changed = self.update_state()
+        stale = self.timers.run() or changed
+        self.dispatch_edges()
+        states = self.states
+        for key, interface in self.polled:
+            io_id = self.interface_ios[key]
+            if not self.ios[io_id].degraded:
+                try:
+                    with smbio.scheduler.priority(interface.PRIORITY):
+                        message = interface.update()
+                except OSError as err:
+                    self.io_failed(io_id, err)
+                else:
+                    self.process_interface(interface, message)
+                    messages = interface.pull_messages()
+                    if messages:
+                        self.process_messages(messages)
+                        stale = True
             states[key] = interface.get_state()
-        self.log_state(states)
+        if stale:
+            self.refresh_outputs()
+
+    def refresh_outputs(self):
+        for key, interface in self.outputs:
+            self.states[key] = interface.get_state()
+
+    def current_states(self):
+        self.states["faults"] = [
+            io_id for io_id, io in self.ios.items() if io.degraded]
+        return self.states
+
+    def dispatch_edges(self):
+        '''
+        hand edge interfaces the pins that changed since the last tick,
+        after an alarm state change every edge interface is handed its
+        current level so a switch held open is seen in the new state
+        '''
+        state = self.state  # commands may change it from another thread
+        full = state != self.edge_state
+        for io_id, io, pins in self.edge_index:
+            if self.ios[io_id].degraded:
+                continue
+            changed = io.changed
+            if not (changed or full):
+                continue
+            io.changed = 0x00
+            level = io.gpio_val
+            if full:
+                changed = 0xff
+            while changed:
+                bit = changed & -changed
+                changed ^= bit
+                pin = bit.bit_length() - 1
+                if pin not in pins:
+                    continue
+                for interface in pins[pin]:
+                    self.process_interface(
+                        interface, interface.change((level >> pin) & 1))
+                    self.states[interface.pid] = interface.get_state()
+        self.edge_state = state
 
     def main(self):
         self.log("Alarm main loop starting")
         while self._running:
+            started = time.thread_time()
             self.update()
-            time.sleep(Config["alarm_sleep"])
+            self.tick_cpu += time.thread_time() - started
+            self.ticks += 1
+            self.wait()
         self.log("Alarm main loop stoped")
 
+    def interrupt_mode(self):
+        return self.int_line is not None and Config["interrupt_mode"]
+
+    def next_deadline(self, now):
+        '''
+        monotonic time the next tick is due, the sample period or
+        the interrupt timeout unless a timer or state timeout is sooner
+        '''
+        deadline = self.state_deadline(now)
+        timer = self.timers.next_deadline()
+        if timer is not None:
+            deadline = min(deadline, timer)
+        return deadline
+
+    def state_deadline(self, now):
+        '''next_deadline leaving out the timers'''
+        if self.interrupt_mode():
+            deadline = now + Config["interrupt_timeout"]
+        else:
+            deadline = now + Config["sample_period"]
+        if self.state == Alarm.ARMDELAY:
+            deadline = min(deadline, self.armtime + Config["arm_delay"])
+        elif self.state == Alarm.TRIPPED:
+            deadline = min(deadline, self.last + Config["tripped_timeout"])
+        elif self.state == Alarm.FAULT:
+            deadline = min(deadline, self.last + Config["faulted_timeout"])
+        return deadline
+
+    def wakeup(self):
+        '''end the current wait early, safe from any thread'''
+        self.waker.wake()
+
+    def wait(self):
+        '''
+        sleep until the next deadline, an interrupt edge or a wakeup()
+        '''
+        # a bouncing pin would wake the loop on every edge, while one
+        # settles it is sampled at the sample period so the debounce
+        # window keeps its length
+        settling = self.interrupt_mode() and any(
+            io.settling() for io in self.ios.values())
+        if self.latched and not settling:
+            return  # a latched edge was merged in, sample the live level
+        if any(i.scanning() for i in self.interfaces.values()):
+            return
+        now = time.monotonic()
+        deadline = self.next_deadline(now)
+        if settling:
+            deadline = min(deadline, now + Config["sample_period"])
+            lines = []
+        elif self.interrupt_mode():
+            lines = [self.int_line]
+        else:
+            lines = []
+        if self.acquirer is not None and self.acquirer.alive():
+            lines.append(self.acquirer)
+        ready = self.waker.wait(max(0, deadline - now), *lines)
+        for line in ready:
+            line.drain()
+
+    def loop_report(self):
+        '''ticks per second and cpu time per tick since the last report'''
+        now, ticks, cpu = time.monotonic(), self.ticks, self.tick_cpu
+        last, last_ticks, last_cpu = self.loop_mark
+        self.loop_mark = (now, ticks, cpu)
+        ticks -= last_ticks
+        return {
+            "ticks_per_s": ticks / (now - last) if now > last else 0,
+            "cpu_per_tick_ms": (cpu - last_cpu) * 1000 / ticks if ticks else 0,
+            "acquire": self.acquirer.report() if self.acquirer else None,
+            "verify": self.verify_report()}
+
+    def verify_report(self):
+        '''code checks finished since the last report and their latency'''
+        count, total, peak = self.verify_stats
+        self.verify_stats = (0, 0.0, 0.0)
+        return {
+            "count": count,
+            "in_flight": len(self.verifying),
+            "latency_ms": total * 1000 / count if count else 0,
+            "latency_max_ms": peak * 1000}
+
     def process_interface(self, interface, message):
         for key in message:
             if key in self.MESSAGES:
@@ -395,9 +1006,30 @@ class Alarm:
                 func(message[key], interface)
 
     def process_messages(self, messages):
-        for key in self.interfaces:
-            interface = self.interfaces[key]
-            interface.process_messages(messages)
+        for topic, target in messages:
+            if target is None:
+                for interface in self.subscribers.get(topic, ()):
+                    interface.process_messages([topic])
+            elif target in self.interfaces:
+                interface = self.interfaces[target]
+                if topic in interface.SUBSCRIBES:
+                    interface.process_messages([topic])
+
+    def trace(self, command):
+        for traced in self.traces.values():
+            if command == "on":
+                traced.enable()
+            elif command == "off":
+                traced.disable()
+            elif command == "reset":
+                traced.reset()
+            else:
+                raise ValueError("Bad trace command '%s'" % (command,))
+
+    def submit_command(self, cmd, reason):
+        '''run a command from another thread and wake the loop for it'''
+        self.process_command(cmd, reason)
+        self.wakeup()
 
     def process_command(self, cmd, reason):
         if cmd in self.ACTIONS:
@@ -407,17 +1039,91 @@ class Alarm:
     def process_input(self, data, interface):
         if data:
             self.log("got input from interface %s: %s" % (interface.pid, data))
-            for key in self.actions:
-                action = self.actions[key]
-                code_hash = action["code_hash"]
-                if bcrypt.hashpw(
-                        data.encode('UTF-8'),
-                        code_hash.encode('UTF-8')
-                        ).decode('UTF-8') == code_hash:
-                    self.process_command(
-                        action["command"],
-                        action["reason"])
-                    break
+            if interface.pid in self.verifying:
+                self.verifying[interface.pid].append(data)
+            else:
+                self.verifying[interface.pid] = deque()
+                self.submit_verify(data, interface)
+
+    def submit_verify(self, data, interface):
+        '''check a code on the verify pool, the result comes back later'''
+        started = time.monotonic()
+        tag = None
+        if self.code_key is not None:
+            tag = codes.code_tag(data, self.code_key)
+        # one bcrypt for a tagged code, untagged actions are checked after
+        candidates = self.action_tags.get(tag, []) + self.untagged
+        future = self.verify_pool.submit(self.verify_code, data, candidates)
+
+        def done(future):
+            self.verified.append((interface, started, tag, future))
+            self.wakeup()
+        future.add_done_callback(done)
+
+    def verify_code(self, data, actions):
+        '''runs on the verify pool, returns the matching action or None'''
+        for action in actions:
+            code_hash = action["code_hash"]
+            if bcrypt.hashpw(
+                    data.encode('UTF-8'),
+                    code_hash.encode('UTF-8')
+                    ).decode('UTF-8') == code_hash:
+                return action
+        return None
+
+    def tag_action(self, action, tag):
+        '''store the tag of an action saved before code tags'''
+        if self.write_tag(action, tag):
+            self.index_tag(action, tag)
+
+    def write_tag(self, action, tag):
+        '''returns True if the tag was stored'''
+        try:
+            with database.connection() as db:
+                db.cursor().execute(
+                    "update action set code_tag = :tag "
+                    "where action_id = :action_id;",
+                    {"tag": tag, "action_id": action["action_id"]})
+                db.commit()
+        except Exception as err:
+            self.log("Error tagging action %s" % (action["action_id"],),
+                     error=err)
+            return False
+        return True
+
+    def index_tag(self, action, tag):
+        if action["code_tag"] is not None:
+            return  # tagged by an earlier check of the same code
+        action["code_tag"] = tag
+        self.untagged.remove(action)
+        self.action_tags.setdefault(tag, []).append(action)
+
+    def process_verified(self):
+        '''
+        act on finished code checks and start the next code
+        queued by the same interface
+        '''
+        while self.verified:
+            interface, started, tag, future = self.verified.popleft()
+            elapsed = time.monotonic() - started
+            count, total, peak = self.verify_stats
+            self.verify_stats = (
+                count + 1, total + elapsed, max(peak, elapsed))
+            try:
+                action = future.result()
+            except Exception as err:
+                self.log("Error verifying code from interface %s" % (
+                    interface.pid,), error=err)
+                action = None
+            if action is not None:
+                if tag is not None and action["code_tag"] is None:
+                    self.tag_action(action, tag)
+                self.process_command(action["command"], action["reason"])
+            queued = self.verifying.get(interface.pid)
+            if queued:
+                self.submit_verify(queued.popleft(), interface)
+            else:
+                self.verifying.pop(interface.pid, None)
 
     def process_switch(self, state, interface):
         if state:
@@ -425,6 +1131,221 @@ class Alarm:
                 interface.pid, interface.desc))
 
 
+class AsyncAlarm(Alarm):
+    '''
+    Alarm engine on an asyncio loop in the alarm thread
+
+    sampling, timers, command intake, persistence and log notices
+    are separate tasks, blocking I2C and sqlite calls run on one
+    worker thread each so a slow database never holds up sampling.
+    the alarm state and logic are those of Alarm, every task that
+    touches the devices holds io_lock so ticks never interleave
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.lag_count = 0
+
+    def main(self):
+        self.log("Alarm main loop starting")
+        asyncio.run(self.amain())
+        self.log("Alarm main loop stoped")
+
+    async def amain(self):
+        self.loop = asyncio.get_running_loop()
+        self.io_executor = ThreadPoolExecutor(1, "alarm-i2c")
+        self.db_executor = ThreadPoolExecutor(1, "alarm-db")
+        self.io_lock = asyncio.Lock()
+        self.woken = asyncio.Event()
+        self.rescheduled = asyncio.Event()
+        self.dirty = asyncio.Event()
+        self.commands = asyncio.Queue()
+        self.notices = asyncio.Queue()
+        self.loop.add_reader(self.waker.fileno(), self.on_wakeup)
+        if self.interrupt_mode():
+            self.loop.add_reader(self.int_line.fileno(), self.on_interrupt)
+        self.watched = None
+        self.watch_acquirer()
+        tasks = [asyncio.ensure_future(task) for task in (
+            self.run_timers(),
+            self.run_commands(),
+            self.run_persistence(),
+            self.run_notices())]
+        try:
+            await self.run_sampling()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.remove_reader(self.waker.fileno())
+            if self.interrupt_mode():
+                self.loop.remove_reader(self.int_line.fileno())
+            if self.watched is not None:
+                self.loop.remove_reader(self.watched_fd)
+                self.watched = None
+            self.loop = None  # logs from here on are written directly
+            while not self.notices.empty():
+                await self.in_db(
+                    database.write_log, *self.notices.get_nowait())
+            await self.in_db(self.log_state, dict(self.current_states()))
+            self.io_executor.shutdown()
+            self.db_executor.shutdown()
+
+    def in_io(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.io_executor, func, *args)
+
+    def in_db(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.db_executor, func, *args)
+
+    def on_wakeup(self):
+        self.waker.drain()
+        self.woken.set()
+
+    def on_interrupt(self):
+        if self.int_line.drain():
+            self.woken.set()
+
+    def watch_acquirer(self):
+        '''wait on the current acquisition process while it is alive'''
+        acquirer = self.acquirer
+        if acquirer is not None and not acquirer.alive():
+            acquirer = None
+        if acquirer is self.watched:
+            return
+        if self.watched is not None:
+            self.loop.remove_reader(self.watched_fd)
+        self.watched = acquirer
+        if acquirer is not None:
+            self.watched_fd = acquirer.fileno()
+            self.loop.add_reader(self.watched_fd, self.on_acquired)
+
+    def on_acquired(self):
+        if self.watched.drain():
+            self.woken.set()
+        if not self.watched.alive():
+            self.watch_acquirer()  # at EOF the pipe stays readable
+            self.woken.set()
+
+    def submit_command(self, cmd, reason):
+        loop = self.loop
+        if loop is None:
+            super().submit_command(cmd, reason)
+        else:
+            loop.call_soon_threadsafe(
+                self.commands.put_nowait, (cmd, reason))
+
+    def log(self, message, error=None, alarm=False):
+        loop = self.loop
+        if loop is None:
+            super().log(message, error=error, alarm=alarm)
+            return
+        # formatted here, the traceback only exists in the catching thread
+        loop.call_soon_threadsafe(self.notices.put_nowait, (
+            self.format_log(message, error), error is not None, alarm))
+
+    def tag_action(self, action, tag):
+        '''the update runs on the database worker, not the loop'''
+        if self.loop is None:
+            super().tag_action(action, tag)
+            return
+        future = self.in_db(self.write_tag, action, tag)
+        future.add_done_callback(
+            lambda done: done.result() and self.index_tag(action, tag))
+
+    async def run_sampling(self):
+        while self._running:
+            async with self.io_lock:
+                self.latched = False
+                self.check_acquirer()
+                self.watch_acquirer()
+                await self.in_io(self.update_devices)
+                started = time.thread_time()
+                self.tick()
+                self.tick_cpu += time.thread_time() - started
+                self.ticks += 1
+                await self.in_io(self.flush_devices)
+            self.rescheduled.set()
+            self.dirty.set()
+            await self.wait_async()
+
+    async def wait_async(self):
+        '''the asyncio side of Alarm.wait'''
+        if self.interrupt_mode() and any(
+                io.settling() for io in self.ios.values()):
+            await asyncio.sleep(Config["sample_period"])
+            return
+        if self.latched or any(
+                i.scanning() for i in self.interfaces.values()):
+            await asyncio.sleep(0)
+            return
+        now = time.monotonic()
+        deadline = self.state_deadline(now)
+        try:
+            await asyncio.wait_for(self.woken.wait(), deadline - now)
+        except asyncio.TimeoutError:
+            lag = time.monotonic() - deadline
+            self.lag_total += lag
+            self.lag_count += 1
+            if lag > self.lag_max:
+                self.lag_max = lag
+        self.woken.clear()
+
+    async def run_timers(self):
+        while True:
+            deadline = self.timers.next_deadline()
+            self.rescheduled.clear()
+            try:
+                await asyncio.wait_for(
+                    self.rescheduled.wait(),
+                    None if deadline is None else max(
+                        0, deadline - time.monotonic()))
+                continue
+            except asyncio.TimeoutError:
+                pass
+            async with self.io_lock:
+                if self.timers.run():
+                    self.refresh_outputs()
+                    await self.in_io(self.flush_devices)
+                    self.dirty.set()
+
+    async def run_commands(self):
+        while True:
+            cmd, reason = await self.commands.get()
+            async with self.io_lock:
+                self.process_command(cmd, reason)
+            self.woken.set()
+
+    async def run_persistence(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            try:
+                await self.in_db(self.log_state, dict(self.current_states()))
+            except Exception as err:
+                self.log("Error writing alarm state", error=err)
+
+    async def run_notices(self):
+        while True:
+            notice = await self.notices.get()
+            try:
+                await self.in_db(database.write_log, *notice)
+            except Exception:
+                traceback.print_exc()
+
+    def loop_report(self):
+        report = super().loop_report()
+        count, total, peak = self.lag_count, self.lag_total, self.lag_max
+        self.lag_count, self.lag_total, self.lag_max = 0, 0.0, 0.0
+        report["wake_lag_ms"] = total * 1000 / count if count else 0
+        report["wake_lag_max_ms"] = peak * 1000
+        return report
+
+
 def write_pid():
     with open(Config["pidfile"], "w") as f:
         f.write(str(os.getpid()))
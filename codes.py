@@ -0,0 +1,48 @@
+import os
+import hmac
+import hashlib
+from config import Config
+
+_key = None
+
+
+def load_key():
+    '''
+    return the device secret used to tag alarm codes,
+    it lives in its own file outside the database and is
+    created on first use
+    '''
+    global _key
+    if _key is None:
+        path = Config["code_key_file"]
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32))
+        with open(path, "rb") as f:
+            key = f.read()
+        if len(key) < 16:
+            raise ValueError("code key file %s is too short" % (path,))
+        _key = key
+    return _key
+
+
+def code_tag(code, key=None):
+    '''keyed lookup tag of a code, equal codes give equal tags'''
+    if key is None:
+        key = load_key()
+    return hmac.new(key, code.encode('UTF-8'), hashlib.sha256).hexdigest()
+
+
+def key_fingerprint(key=None):
+    '''
+    short digest naming the key, stored with the tags so
+    a lost or replaced key file can be noticed
+    '''
+    if key is None:
+        key = load_key()
+    return hmac.new(
+        key, b"code key fingerprint", hashlib.sha256).hexdigest()[:16]
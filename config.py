@@ -20,6 +20,21 @@ del app_path
 if "dbfile" not in Config:
     Config["dbfile"] = "alarm.db"
 
+if "db_synchronous" not in Config:
+    Config["db_synchronous"] = "NORMAL"
+
+if "db_cache_size" not in Config:
+    Config["db_cache_size"] = -2000  # negative is KiB
+
+if "db_busy_timeout" not in Config:
+    Config["db_busy_timeout"] = 5000  # ms
+
+if "db_cached_statements" not in Config:
+    Config["db_cached_statements"] = 64
+
+if "db_pool_size" not in Config:
+    Config["db_pool_size"] = 4
+
 if "host" not in Config:
     Config["host"] = "0.0.0.0"
 
@@ -38,17 +53,44 @@ if "faulted_timeout" not in Config:
 if "secret" not in Config:
     Config["secret"] = "ChangeMeNow"
 
+if "log_queue_size" not in Config:
+    Config["log_queue_size"] = 1000
+
+if "log_batch" not in Config:
+    Config["log_batch"] = 50
+
+if "log_interval" not in Config:
+    Config["log_interval"] = 0.5
+
 if "title" not in Config:
     Config["title"] = "Alarm System"
 
 if "pidfile" not in Config:
     Config["pidfile"] = "/var/run/alarmsystem.pid"
 
+if "web_hash_workers" not in Config:
+    Config["web_hash_workers"] = 2
+
+if "web_hash_queue" not in Config:
+    Config["web_hash_queue"] = 4
+
+if "web_hash_per_client" not in Config:
+    Config["web_hash_per_client"] = 1
+
 if "manager_sleep" not in Config:
     Config["manager_sleep"] = 1
 
-if "alarm_sleep" not in Config:
-    Config["alarm_sleep"] = 0
+if "sample_period" not in Config:
+    Config["sample_period"] = 0.01
+
+if "engine" not in Config:
+    Config["engine"] = "thread"
+
+if "code_key_file" not in Config:
+    Config["code_key_file"] = "code.key"
+
+if "state_flush_interval" not in Config:
+    Config["state_flush_interval"] = 1
 
 if "auto_arm" not in Config:
     Config["auto_arm"] = False
@@ -58,3 +100,57 @@ if "arm_delay" not in Config:
 
 if "auto_start" not in Config:
     Config["auto_start"] = True
+
+if "io_verify" not in Config:
+    Config["io_verify"] = "never"
+
+if "io_verify_every" not in Config:
+    Config["io_verify_every"] = 60
+
+if "interrupt_mode" not in Config:
+    Config["interrupt_mode"] = False
+
+if "interrupt_chip" not in Config:
+    Config["interrupt_chip"] = "/dev/gpiochip0"
+
+if "interrupt_line" not in Config:
+    Config["interrupt_line"] = 4
+
+if "interrupt_timeout" not in Config:
+    Config["interrupt_timeout"] = 0.1
+
+if "interrupt_open_drain" not in Config:
+    Config["interrupt_open_drain"] = False
+
+if "bus_backend" not in Config:
+    Config["bus_backend"] = "smbus"
+
+if "bus_scheduler" not in Config:
+    Config["bus_scheduler"] = False
+
+if "bus_trace" not in Config:
+    Config["bus_trace"] = False
+
+if "verify_workers" not in Config:
+    Config["verify_workers"] = 2
+
+if "acquire_process" not in Config:
+    Config["acquire_process"] = False
+
+if "acquire_period" not in Config:
+    Config["acquire_period"] = 0.002
+
+if "acquire_slots" not in Config:
+    Config["acquire_slots"] = 64
+
+if "acquire_timeout" not in Config:
+    Config["acquire_timeout"] = 1.0
+
+if "io_fail_threshold" not in Config:
+    Config["io_fail_threshold"] = 3
+
+if "io_backoff" not in Config:
+    Config["io_backoff"] = 1
+
+if "io_backoff_max" not in Config:
+    Config["io_backoff_max"] = 60
@@ -1,33 +1,211 @@
 import os
+import sys
 import time
+import queue
+import atexit
 import sqlite3
-from contextlib import closing
+import itertools
+import threading
+from collections import deque
+from contextlib import closing, contextmanager
 import config
 
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+_idle = queue.LifoQueue()
+
 
 def init_db():
     with closing(get_db()) as db:
         schema_path = os.path.join(config.Config["app_path"], "schema.sql")
         with open(schema_path, "r") as f:
             db.executescript(f.read())
+        migrate_db(db)
         db.commit()
 
 
+def migrate_db(db):
+    '''add columns newer than an existing database'''
+    c = db.cursor()
+    c.execute("pragma table_info(action);")
+    if "code_tag" not in [row[1] for row in c.fetchall()]:
+        c.execute("alter table action add column code_tag text;")
+
+
 def get_db():
-    conn = sqlite3.connect(config.Config["dbfile"])
+    '''open a new connection with the configured pragmas'''
+    synchronous = config.Config["db_synchronous"].upper()
+    if synchronous not in SYNCHRONOUS:
+        raise ValueError("bad db_synchronous: {}".format(synchronous))
+    conn = sqlite3.connect(
+        config.Config["dbfile"],
+        timeout=config.Config["db_busy_timeout"] / 1000,
+        cached_statements=config.Config["db_cached_statements"],
+        check_same_thread=False)  # pooled, used by one thread at a time
+    conn.execute("pragma journal_mode = WAL;")
+    conn.execute(
+        "pragma busy_timeout = %d;" % (config.Config["db_busy_timeout"],))
+    conn.execute("pragma synchronous = %s;" % (synchronous,))
+    conn.execute("pragma cache_size = %d;" % (config.Config["db_cache_size"],))
     return conn
 
 
+def acquire():
+    '''take an idle pooled connection or open one'''
+    try:
+        return _idle.get_nowait()
+    except queue.Empty:
+        return get_db()
+
+
+def release(db):
+    '''hand a connection back to the pool, rolling back unfinished work'''
+    if db.in_transaction:
+        db.rollback()
+    if _idle.qsize() < config.Config["db_pool_size"]:
+        _idle.put(db)
+    else:
+        db.close()
+
+
+@contextmanager
+def connection():
+    '''borrow a pooled connection for the length of a with block'''
+    db = acquire()
+    try:
+        yield db
+    finally:
+        release(db)
+
+
+class LogWriter:
+    '''
+    Write log records from a background thread in batches
+
+    records wait in a bounded queue and are written in one transaction
+    every interval seconds or once batch of them are waiting. when the
+    queue is full ordinary records are dropped and counted, alarm
+    records go to an unbounded side queue and are never dropped.
+    a batch that fails to write is kept and retried with the next one
+    '''
+
+    def __init__(self, size, batch, interval):
+        self.records = queue.Queue(size)
+        self.failed = []  # already printed, waiting to be written again
+        self.alarms = deque()
+        self.batch = batch
+        self.interval = interval
+        self.seq = itertools.count()
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.lock = threading.Lock()  # held while a batch is written
+        self.thread = threading.Thread(
+            target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, message, error, alarm):
+        record = {
+            "seq": next(self.seq),
+            "error": error,
+            "alarm": alarm,
+            "message": message,
+            "time": time.time()}
+        if alarm:
+            self.alarms.append(record)
+            self.wake.set()
+            return
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.records.qsize() >= self.batch:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as err:
+                print("Error writing log records:", err,
+                      file=sys.stderr, flush=True)
+
+    def take(self):
+        '''
+        the next batch to write, a failed batch is retried first and
+        the queue is left to fill meanwhile, alarm records are always
+        taken so they never wait on a full queue
+        '''
+        records = []
+        while self.alarms:
+            records.append(self.alarms.popleft())
+        if not self.failed:
+            while True:
+                try:
+                    records.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.append({
+                    "seq": next(self.seq),
+                    "error": True,
+                    "alarm": False,
+                    "message": "%d log records dropped, queue full" % (
+                        dropped,),
+                    "time": time.time()})
+        records.sort(key=lambda record: record["seq"])
+        for record in records:
+            print(record["message"])
+        sys.stdout.flush()
+        records = self.failed + records
+        records.sort(key=lambda record: record["seq"])
+        self.failed = []
+        return records
+
+    def flush(self):
+        '''
+        write every waiting record, safe from any thread, a batch
+        that fails is kept for the next flush and the error raised
+        '''
+        with self.lock:
+            while True:
+                records = self.take()
+                if not records:
+                    return
+                try:
+                    with connection() as db:
+                        db.executemany(
+                            "insert into log "
+                            "(error, alarm, message, log_time) "
+                            "values (:error, :alarm, :message, :time);",
+                            records)
+                        db.commit()
+                except Exception:
+                    self.failed = records
+                    raise
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
 def write_log(message, error=False, alarm=False):
-    with closing(get_db()) as db:
-        print(message, flush=True)
-        db.cursor().execute(
-            "insert into log "
-            "(error, alarm, message, log_time) "
-            "values (:error, :alarm, :message, :time);",
-            {
-                "error": error,
-                "alarm": alarm,
-                "message": message,
-                "time": time.time()})
-        db.commit()
+    '''queue a log record for the background writer'''
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(
+                    config.Config["log_queue_size"],
+                    config.Config["log_batch"],
+                    config.Config["log_interval"])
+                atexit.register(flush_log)
+    _writer.put(message, error, alarm)
+
+
+def flush_log():
+    '''write out every queued log record before returning'''
+    if _writer is not None:
+        _writer.flush()
@@ -0,0 +1,82 @@
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+
+class Busy(Exception):
+    '''too many hashes in flight, for the pool or for one client'''
+
+
+class HashPool:
+    '''
+    Run password hashing on a bounded pool of worker threads
+
+    at most workers hashes run at once and workers + queue are
+    admitted, a client may only have per_client in flight,
+    anything over either limit is turned away with Busy
+    instead of piling up behind the others
+    '''
+
+    def __init__(self, workers, queue, per_client):
+        self.executor = ThreadPoolExecutor(workers, "web-hash")
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.per_client = per_client
+        self.lock = threading.Lock()
+        self.clients = Counter()
+        self.stats = {}  # op: [count, total, max] seconds
+        self.rejected = 0
+
+    def run(self, op, client, func, *args):
+        '''run func(*args) on the pool and wait for its result'''
+        with self.lock:
+            if self.clients[client] >= self.per_client:
+                self.rejected += 1
+                raise Busy("client %s has a hash in flight" % (client,))
+            if not self.slots.acquire(blocking=False):
+                self.rejected += 1
+                raise Busy("hash pool is full")
+            self.clients[client] += 1
+        started = time.monotonic()
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.clients[client] -= 1
+                if not self.clients[client]:
+                    del self.clients[client]
+                self.slots.release()
+                stat = self.stats.setdefault(op, [0, 0.0, 0.0])
+                stat[0] += 1
+                stat[1] += elapsed
+                stat[2] = max(stat[2], elapsed)
+
+    def report(self):
+        '''latency per operation in milliseconds, queueing included'''
+        with self.lock:
+            return {
+                "in_flight": sum(self.clients.values()),
+                "rejected": self.rejected,
+                "ops": {
+                    op: {
+                        "count": count,
+                        "avg": total * 1000 / count if count else 0,
+                        "max": peak * 1000}
+                    for op, (count, total, peak) in self.stats.items()}}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HashPool(
+                Config["web_hash_workers"],
+                Config["web_hash_queue"],
+                Config["web_hash_per_client"])
+        return _pool
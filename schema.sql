@@ -35,6 +35,7 @@ create table if not exists log (
 create table if not exists action (
     action_id integer unique primary key autoincrement,
     code_hash text not null,
+    code_tag text,
     command text not null,
     reason text not null
 );
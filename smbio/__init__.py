@@ -1,9 +1,16 @@
 # SMBus Peripheral Wrapper lib
 
+from . import acquire
+from . import debounce
 from . import detector
+from . import gpio
 from . import indicator
 from . import interface
 from . import ioexpander
+from . import scheduler
+from . import sim
+from . import timer
+from . import trace
 from . import smb
 
 IOTYPES = {
@@ -23,6 +30,10 @@ IOMAP = {
     "MCP23008": ioexpander.MCP23008,
     "MCP23017": ioexpander.MCP23017}
 
+SIMMAP = {
+    "MCP23008": sim.MCP23008,
+    "MCP23017": sim.MCP23017}
+
 INTERFACEMAP = {
     "Led": indicator.Led,
     "LedBlink": indicator.LedBlink,
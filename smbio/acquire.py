@@ -0,0 +1,244 @@
+import os
+import time
+import errno
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from . import smb
+
+HEADER = struct.Struct("=Q")  # sequence of the newest snapshot
+SLOT = struct.Struct("=Qd")  # sequence, monotonic time it was taken
+
+
+class Ring:
+    '''
+    Fixed size ring of timestamped port snapshots in shared memory
+
+    the writer zeroes a slot's sequence while filling it, a reader
+    that races the writer sees the sequence change and drops the slot
+    '''
+
+    def __init__(self, slots, width, name=None):
+        self.slots = slots
+        self.width = width
+        self.size = SLOT.size + width
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=HEADER.size + slots * self.size)
+            self.shm.buf[:HEADER.size] = bytes(HEADER.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.seq = self.newest()
+
+    def offset(self, seq):
+        return HEADER.size + (seq % self.slots) * self.size
+
+    def newest(self):
+        return HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def write(self, data):
+        seq = self.seq + 1
+        offset = self.offset(seq)
+        SLOT.pack_into(self.shm.buf, offset, 0, 0.0)
+        start = offset + SLOT.size
+        self.shm.buf[start:start + self.width] = data
+        SLOT.pack_into(self.shm.buf, offset, seq, time.monotonic())
+        HEADER.pack_into(self.shm.buf, 0, seq)
+        self.seq = seq
+
+    def read(self, seq):
+        '''return (timestamp, data) of snapshot seq or None if overwritten'''
+        offset = self.offset(seq)
+        found, stamp = SLOT.unpack_from(self.shm.buf, offset)
+        start = offset + SLOT.size
+        data = bytes(self.shm.buf[start:start + self.width])
+        if found != seq or SLOT.unpack_from(self.shm.buf, offset)[0] != seq:
+            return None
+        return stamp, data
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def layout(specs):
+    '''offset of every spec in a snapshot and the snapshot width'''
+    offsets = []
+    width = 0
+    for bus, addr, reads in specs:
+        offsets.append(width)
+        width += 1 + sum(count for reg, count in reads)
+    return offsets, width
+
+
+def acquire(ring, buses, specs, period, notify=None, running=None):
+    '''
+    sample every spec once a period and write the snapshot to ring
+
+    specs are (bus, addr, reads) with reads a list of (register, count),
+    in the snapshot each spec takes an errno byte, 0 when its reads
+    worked, followed by its port values. notify is sent a byte
+    whenever a snapshot differs from the one before
+    '''
+    offsets, width = layout(specs)
+    data = bytearray(width)
+    last = None
+    deadline = time.monotonic()
+    while running is None or running():
+        for offset, (bus, addr, reads) in zip(offsets, specs):
+            values = []
+            try:
+                for reg, count in reads:
+                    if count == 1:
+                        values.append(buses[bus].read_byte_data(addr, reg))
+                    else:
+                        values.extend(
+                            buses[bus].read_i2c_block_data(addr, reg, count))
+            except OSError as err:
+                data[offset] = min(err.errno or errno.EIO, 0xff)
+                continue  # keep the last good values
+            data[offset] = 0
+            data[offset + 1:offset + 1 + len(values)] = bytes(
+                value & 0xff for value in values)
+        ring.write(data)
+        if notify is not None and data != last:
+            last = bytes(data)
+            try:
+                notify.send_bytes(b"\0")
+            except BlockingIOError:
+                pass  # the engine has a wakeup pending already
+        deadline += period
+        now = time.monotonic()
+        if deadline > now:
+            time.sleep(deadline - now)
+        else:
+            deadline = now  # fell behind, do not try to catch up
+
+
+def main(name, slots, width, specs, backend, period, notify):
+    '''entry point of the acquisition process'''
+    ring = Ring(slots, width, name)
+    os.set_blocking(notify.fileno(), False)
+    buses = {}
+    for bus, addr, reads in specs:
+        if bus not in buses:
+            buses[bus] = smb.Bus(bus, backend)
+    try:
+        acquire(ring, buses, specs, period, notify)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+class Acquirer:
+    '''
+    Engine side of the acquisition process
+
+    the process owns its own bus handles and only reads the GPIO
+    ports of the groups in specs, every group is fed the snapshots
+    it has not seen yet through IOGroup.feed()
+    '''
+
+    def __init__(self, specs, backend="smbus", period=0.002, slots=64,
+                 timeout=1.0, start=True):
+        self.specs = specs
+        self.timeout = timeout
+        self.offsets, width = layout(specs)
+        self.ring = Ring(slots, width)
+        self.cursors = [1] * len(specs)
+        self.mark = (time.monotonic(), 0)
+        self.process = None
+        self.conn = None
+        self.eof = False
+        if start:
+            ctx = multiprocessing.get_context("spawn")
+            self.conn, notify = ctx.Pipe(duplex=False)
+            self.process = ctx.Process(
+                target=main,
+                args=(self.ring.name, slots, width, specs, backend, period,
+                      notify),
+                name="alarm-acquire",
+                daemon=True)
+            self.process.start()
+            notify.close()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def drain(self):
+        '''discard queued wakeups, returns True if there were any'''
+        got = False
+        try:
+            while self.conn.poll():
+                self.conn.recv_bytes()
+                got = True
+        except EOFError:
+            self.eof = True  # the process is gone
+        return got
+
+    def alive(self):
+        if self.process is None:
+            return True
+        return not self.eof and self.process.is_alive()
+
+    def stale(self, newest):
+        if not self.alive():
+            return True
+        if not newest:
+            return False  # nothing written yet
+        snapshot = self.ring.read(newest)
+        return snapshot is not None and (
+            time.monotonic() - snapshot[0] > self.timeout)
+
+    def sample(self, index, group):
+        '''
+        feed group the snapshots written since it last sampled,
+        stopping after the first one that changes a pin so no edge
+        is merged away, returns True if snapshots are left over
+        '''
+        newest = self.ring.newest()
+        if self.stale(newest):
+            raise OSError(errno.ETIMEDOUT, "acquisition process stalled")
+        seq = max(self.cursors[index], newest - self.ring.slots + 1)
+        offset = self.offsets[index]
+        end = offset + 1 + len(group.ios)
+        try:
+            while seq <= newest:
+                snapshot = self.ring.read(seq)
+                seq += 1
+                if snapshot is None:
+                    continue  # overwritten while reading it
+                data = snapshot[1]
+                if data[offset]:
+                    raise OSError(data[offset], os.strerror(data[offset]))
+                if group.feed(data[offset + 1:end]):
+                    break
+        finally:
+            self.cursors[index] = seq
+        return seq <= newest
+
+    def report(self):
+        '''snapshots per second since the last report and their age'''
+        now = time.monotonic()
+        newest = self.ring.newest()
+        last, last_seq = self.mark
+        self.mark = (now, newest)
+        snapshot = self.ring.read(newest) if newest else None
+        return {
+            "alive": self.alive(),
+            "snapshots_per_s": (
+                (newest - last_seq) / (now - last) if now > last else 0),
+            "age_ms": (now - snapshot[0]) * 1000 if snapshot else None}
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.ring.close(unlink=True)
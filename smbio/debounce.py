@@ -0,0 +1,58 @@
+from collections import deque
+from functools import reduce
+from operator import and_, or_
+
+
+class Debouncer:
+    '''
+    Debounce every pin of a port at once on integer masks
+
+    pins are grouped by window, the number of samples in a row a pin
+    must hold a new level before the debounced value follows it.
+    each group keeps its last window samples, a bit set in all of them
+    is high, a bit clear in all of them is low, anything else keeps
+    its old debounced level. pins without a window pass straight through
+    '''
+
+    def __init__(self):
+        self.windows = {}  # window: mask of pins
+        self.history = {}  # window: last window raw samples
+        self.mask = 0x00  # every pin with a window
+        self.state = None
+        self.settling = 0x00  # pins whose samples disagree
+
+    def set_window(self, pin, window):
+        bit = 1 << pin
+        for old in list(self.windows):
+            self.windows[old] &= ~bit
+            if not self.windows[old]:
+                del self.windows[old]
+                del self.history[old]
+        if window > 1:
+            if window not in self.windows:
+                self.windows[window] = 0x00
+                self.history[window] = deque(maxlen=window)
+                if self.state is not None:
+                    self.history[window].extend([self.state] * window)
+            self.windows[window] |= bit
+        self.mask = reduce(or_, self.windows.values(), 0x00)
+
+    def update(self, raw):
+        '''feed one raw sample and return the debounced value'''
+        if self.state is None:
+            self.state = raw
+            for window, history in self.history.items():
+                history.extend([raw] * window)
+            return raw
+        value = raw & ~self.mask
+        settling = 0x00
+        for window, mask in self.windows.items():
+            history = self.history[window]
+            history.append(raw)
+            high = reduce(and_, history)
+            low = reduce(or_, history)
+            value |= ((self.state | high) & low) & mask
+            settling |= (high ^ low) & mask
+        self.state = value
+        self.settling = settling
+        return value
@@ -1,25 +1,43 @@
 from .smb import Peripheral
+from . import scheduler
 
 
 class Switch(Peripheral):
 
     DIRECTION = -1
+    EDGE = True
+    PRIORITY = scheduler.SENSOR
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
+    DATAMAP["debounce"] = "int"
 
     def init(self):
         if "pin" in self.data:
             self.pin = int(self.data["pin"])
         else:
             self.pin = 0
+        if "debounce" in self.data:
+            self.debounce = int(self.data["debounce"])
+        else:
+            self.debounce = 0
         self._state = 0
         self.io.set_mode_pin(self.pin, self.io.READ)
+        self.io.enable_sampling(1 << self.pin)
+        self.io.set_debounce(self.pin, self.debounce)
+
+    def ensure_mode(self):
+        if self.io.get_mode_pin(self.pin) != self.io.READ:
+            self.io.set_mode_pin(self.pin, self.io.READ)
 
     def read(self):
-        self.init()
-        self._state = self.io.read_in_pin(self.pin)
+        self.ensure_mode()
+        self._state = self.io.read_sample_pin(self.pin)
         return self._state
 
     def update(self):
         state = self.read()
         return {"switch": state}
+
+    def change(self, level):
+        self._state = level
+        return {"switch": level}
@@ -0,0 +1,82 @@
+import os
+import fcntl
+import select
+import struct
+
+# linux/gpio.h character device ABI (v1)
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOEVENT_REQUEST_RISING_EDGE = 1 << 0
+GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+
+GPIOEVENT_REQUEST = "III32si"  # struct gpioevent_request
+GPIOEVENT_DATA_SIZE = 16  # struct gpioevent_data (u64 timestamp, u32 id)
+
+# _IOWR(0xB4, 0x04, struct gpioevent_request)
+GPIO_GET_LINEEVENT_IOCTL = (
+    (3 << 30) |
+    (struct.calcsize(GPIOEVENT_REQUEST) << 16) |
+    (0xB4 << 8) |
+    0x04)
+
+
+class EventLine:
+    '''
+    Wait for edges on a host GPIO line through the
+    linux GPIO character device, used for the expander INT output
+
+    anything with fileno(), drain(), wait(timeout) and close()
+    can stand in for it
+    '''
+
+    def __init__(
+            self, chip, line,
+            edge=GPIOEVENT_REQUEST_FALLING_EDGE, consumer="alarm"):
+        self.chip = chip
+        self.line = line
+        request = bytearray(struct.pack(
+            GPIOEVENT_REQUEST,
+            line,
+            GPIOHANDLE_REQUEST_INPUT,
+            edge,
+            consumer.encode('UTF-8')[:31],
+            0))
+        chip_fd = os.open(chip, os.O_RDONLY)
+        try:
+            fcntl.ioctl(chip_fd, GPIO_GET_LINEEVENT_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+        self.fd = struct.unpack(GPIOEVENT_REQUEST, request)[4]
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN | select.POLLPRI)
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        '''discard queued events, returns True if there were any'''
+        got = False
+        while True:
+            try:
+                data = os.read(self.fd, GPIOEVENT_DATA_SIZE * 16)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            got = True
+        return got
+
+    def wait(self, timeout):
+        '''
+        block until an edge arrives or timeout seconds pass
+        returns True if an edge arrived
+        '''
+        if self.poller.poll(max(0, int(timeout * 1000))):
+            return self.drain()
+        return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
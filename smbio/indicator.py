@@ -1,10 +1,10 @@
-import time
 from .smb import Peripheral
 
 
 class Led(Peripheral):
 
     DIRECTION = 1
+    POLL = False
 
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
@@ -14,7 +14,7 @@ class Led(Peripheral):
             self.pin = int(self.data["pin"])
         else:
             self.pin = 0
-        self._state = 0
+        self._state = self.io.read_out_pin(self.pin)
         self.io.set_mode_pin(self.pin, self.io.WRITE)
 
     def ensure_mode(self):
@@ -45,6 +45,7 @@ class Led(Peripheral):
 class LedBlink(Peripheral):
 
     DIRECTION = 1
+    POLL = False
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
     DATAMAP["interval"] = "int"
@@ -58,10 +59,12 @@ class LedBlink(Peripheral):
             self.interval = int(self.data["interval"])
         else:
             self.interval = 500
-        self.last = time.time()
-        self._state = 0
+        self._state = self.io.read_out_pin(self.pin)
         self._running = False
+        self.blink = None
         self.io.set_mode_pin(self.pin, self.io.WRITE)
+        if self._state:
+            self.off()  # left on by a restart, update_state restarts blinking
 
     def ensure_mode(self):
         if self.io.get_mode_pin(self.pin) != self.io.WRITE:
@@ -83,25 +86,30 @@ class LedBlink(Peripheral):
         else:
             self.on()
 
+    def flip_timer(self):
+        self.flip()
+        self.blink = self.timers.call_later(
+            self.interval / 1000, self.flip_timer)
+
     def update_state(self, state):
         if bool(state) != bool(self._running):
             self._running = state
+            if state:
+                self.flip_timer()
+            else:
+                self.blink.cancel()
+                self.blink = None
+                if bool(self._state):
+                    self.off()
 
     def update(self):
-        if self._running:
-            now = time.time()
-            if (now - self.last) * 1000 > self.interval:
-                self.last = now
-                self.flip()
-        else:
-            if bool(self._state):
-                self.off()
         return {"ledblink": self._state}
 
 
 class Siren(Peripheral):
 
     DIRECTION = 1
+    POLL = False
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
 
@@ -110,7 +118,7 @@ class Siren(Peripheral):
             self.pin = int(self.data["pin"])
         else:
             self.pin = 0
-        self._state = 0
+        self._state = self.io.read_out_pin(self.pin)
         self.io.set_mode_pin(self.pin, self.io.WRITE)
 
     def ensure_mode(self):
@@ -144,9 +152,11 @@ class Siren(Peripheral):
 class Buzzer(Peripheral):
 
     DIRECTION = 1
+    POLL = False
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
     DATAMAP["length"] = "int"
+    SUBSCRIBES = ("beep",)
 
     def init(self):
         if "pin" in self.data:
@@ -158,10 +168,12 @@ class Buzzer(Peripheral):
         else:
             self.length = 300
 
-        self._state = 0
+        self._state = self.io.read_out_pin(self.pin)
         self.io.set_mode_pin(self.pin, self.io.WRITE)
         self.buzzing = False
-        self.last = 0
+        self.buzz_timer = None
+        if self._state:
+            self.buzz()  # left on by a restart, let it time out
 
     def ensure_mode(self):
         if self.io.get_mode_pin(self.pin) != self.io.WRITE:
@@ -173,8 +185,11 @@ class Buzzer(Peripheral):
 
     def buzz(self):
         self.buzzing = True
-        self.last = time.time()
         self.on()
+        if self.buzz_timer is not None:
+            self.buzz_timer.cancel()
+        self.buzz_timer = self.timers.call_later(
+            self.length / 1000, self.buzz_done)
 
     def on(self):
         self.ensure_mode()
@@ -189,11 +204,10 @@ class Buzzer(Peripheral):
     def get_state(self):
         return self._state
 
-    def update_buzz(self):
-        if (time.time() - self.last) * 1000 > self.length:
-            self.buzzing = False
-            self.last = 0
-            self.off()
+    def buzz_done(self):
+        self.buzzing = False
+        self.buzz_timer = None
+        self.off()
 
     def update_state(self, state):
         if bool(state) != bool(self._state):
@@ -203,18 +217,18 @@ class Buzzer(Peripheral):
                 self.off()
 
     def update(self):
-        if self.buzzing:
-            self.update_buzz()
         return {"buzzer": self._state}
 
 
 class BuzzerRepeat(Peripheral):
 
     DIRECTION = 1
+    POLL = False
     DATAMAP = Peripheral.datamap()
     DATAMAP["pin"] = "pin"
     DATAMAP["length"] = "int"
     DATAMAP["interval"] = "int"
+    SUBSCRIBES = ("beep",)
 
     def init(self):
         if "pin" in self.data:
@@ -230,12 +244,14 @@ class BuzzerRepeat(Peripheral):
         else:
             self.interval = 500
 
-        self._state = 0
+        self._state = self.io.read_out_pin(self.pin)
         self.io.set_mode_pin(self.pin, self.io.WRITE)
         self.buzzing = False
-        self.last = 0
-        self.last_i = 0
+        self.buzz_timer = None
         self.looping = 0
+        self.loop_timer = None
+        if self._state:
+            self.buzz()  # left on by a restart, let it time out
 
     def ensure_mode(self):
         if self.io.get_mode_pin(self.pin) != self.io.WRITE:
@@ -247,8 +263,11 @@ class BuzzerRepeat(Peripheral):
 
     def buzz(self):
         self.buzzing = True
-        self.last = time.time()
         self.on()
+        if self.buzz_timer is not None:
+            self.buzz_timer.cancel()
+        self.buzz_timer = self.timers.call_later(
+            self.length / 1000, self.buzz_done)
 
     def on(self):
         self.ensure_mode()
@@ -263,24 +282,24 @@ class BuzzerRepeat(Peripheral):
     def get_state(self):
         return self._state
 
-    def update_buzz(self):
-        if (time.time() - self.last) * 1000 > self.length:
-            self.buzzing = False
-            self.last = 0
-            self.off()
+    def buzz_done(self):
+        self.buzzing = False
+        self.buzz_timer = None
+        self.off()
 
-    def update_loop(self):
-        if (time.time() - self.last_i) * 1000 > self.interval:
-            self.last_i = time.time()
-            self.buzz()
+    def loop(self):
+        self.buzz()
+        self.loop_timer = self.timers.call_later(
+            self.interval / 1000, self.loop)
 
     def update_state(self, state):
         if bool(state) != bool(self.looping):
             self.looping = state
+            if state:
+                self.loop()
+            else:
+                self.loop_timer.cancel()
+                self.loop_timer = None
 
     def update(self):
-        if self.buzzing:
-            self.update_buzz()
-        if self.looping:
-            self.update_loop()
         return {"buzzerrepeat": self._state}
@@ -1,17 +1,20 @@
 import time
 import re
 from .smb import Peripheral
+from . import scheduler
 
 
 class Keypad4x4Matrix(Peripheral):
 
     DIRECTION = -1
+    PRIORITY = scheduler.KEYPAD
 
     DATAMAP = Peripheral.datamap()
     DATAMAP["upsidedown"] = "bool"
     DATAMAP["repeat"] = "int"
     DATAMAP["timeout"] = "int"
     DATAMAP["beep"] = "bool"
+    DATAMAP["buzzer"] = "int"  # interface id to beep, 0 for every buzzer
 
     MATRIX = [['1', '2', '3', 'A'],
               ['4', '5', '6', 'B'],
@@ -19,6 +22,8 @@ class Keypad4x4Matrix(Peripheral):
               ['*', '0', '#', 'D']]
 
     KEYCOL = [0b0111, 0b1011, 0b1101, 0b1110]
+    ALLCOL = 0b0000  # every column driven low
+    NOROW = 0b1111  # no row pulled low, no key down
     DECODE = {
         0b0111: 0,
         0b1011: 1,
@@ -51,10 +56,18 @@ class Keypad4x4Matrix(Peripheral):
         else:
             self.timeout = 30
 
+        if "buzzer" in self.data:
+            self.buzzer = int(self.data["buzzer"]) or None
+        else:
+            self.buzzer = None
+
         self.matrix = Keypad4x4Matrix.MATRIX
         self.__check_matrix(self.matrix)
 
         self.ensure_mode()
+        self.io.enable_sampling(0xF0)  # the rows
+        self.col = None  # column being scanned, None while idle
+        self.io.write_out(self.ALLCOL)
 
         self.last_t = time.time()
         self.last_s = ""
@@ -63,21 +76,43 @@ class Keypad4x4Matrix(Peripheral):
     def ensure_mode(self):
         if self.io.get_mode() != 0xF0:
             self.io.set_mode(0xF0)  # upper 4 bits are inputs
-        if self.io.get_pullup():
+        if self.io.get_pullup() != 0xF0:
             self.io.set_pullup(0xF0)  # enable upper 4 bits pullups
 
+    def scanning(self):
+        return self.col is not None
+
     def read(self):
+        '''
+        advance the scan by one step without blocking
+
+        the rows come from the port snapshot taken at the start of the
+        tick, so they show the columns written on the previous tick.
+        while idle every column is driven low and one row read tells
+        if any key is down, only then are the columns scanned one per tick
+        '''
         self.ensure_mode()
-        for col in range(0, 4):
-            time.sleep(0.01)
-            self.io.write_out(self.KEYCOL[col])  # write 0 to lowest four bits
-            key = self.io.read_in() >> 4
-            if key in self.DECODE:
-                row = self.DECODE[key]
-                if self.upsidedown:
-                    return self.matrix[row][col]  # keypad right side up
-                else:
-                    return self.matrix[3 - col][3 - row]  # keypad upside down
+        rows = self.io.read_sample() >> 4
+        if self.col is None:
+            if rows == self.NOROW:
+                return ""
+            self.col = 0
+        elif rows in self.DECODE:
+            row = self.DECODE[rows]
+            col = self.col
+            self.col = None
+            self.io.write_out(self.ALLCOL)
+            if self.upsidedown:
+                return self.matrix[row][col]  # keypad right side up
+            else:
+                return self.matrix[3 - col][3 - row]  # keypad upside down
+        else:
+            self.col += 1
+            if self.col > 3:
+                self.col = None
+                self.io.write_out(self.ALLCOL)
+                return ""
+        self.io.write_out(self.KEYCOL[self.col])  # write 0 to one column
         return ""
 
     def update_input(self):
@@ -98,7 +133,7 @@ class Keypad4x4Matrix(Peripheral):
                 self.last_t = now
                 self.in_string += s
                 print("INPUT:", s, self.in_string, flush=True)
-                self.message("beep")
+                self.message("beep", self.buzzer)
         else:
             if now - self.last_t > self.timeout:
                 self.in_string = ""
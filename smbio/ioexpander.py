@@ -1,5 +1,4 @@
-import smbus
-from .smb import IO, IOGroup
+from .smb import IO, IOGroup, Data, is_bus
 
 
 class MCP23008:
@@ -15,16 +14,27 @@ class MCP23008:
     GPIO = 0x09  # Register for inputs
     OLAT = 0x0A  # Register for outputs
     GPPU = 0x6
+    GPINTEN = 0x02  # interrupt on change enable
+    DEFVAL = 0x03  # default compare value for interrupt on change
+    INTCON = 0x04  # interrupt compares against DEFVAL when set
+    IOCON = 0x05  # configuration register
+    INTF = 0x07  # interrupt flags
+    INTCAP = 0x08  # pin levels captured at interrupt
 
     @classmethod
-    def create(cls, bus, addr):
-        if not isinstance(bus, smbus.SMBus):
+    def create(cls, bus, addr, read=True):
+        '''read=False builds it without touching the device'''
+        if not is_bus(bus):
             raise ValueError("bus must be a SMBus instance")
         return IOGroup(
             "MCP23008",
             bus,
             addr,
-            [IO(bus, addr, cls.IODIR, cls.GPIO, cls.OLAT, cls.GPPU)])
+            [IO(
+                bus, addr, cls.IODIR, cls.GPIO, cls.OLAT, cls.GPPU,
+                (cls.GPINTEN, cls.DEFVAL, cls.INTCON, cls.INTF, cls.INTCAP),
+                read)],
+            iocon=cls.IOCON)
 
 
 class MCP23017:
@@ -45,15 +55,65 @@ class MCP23017:
     GPIOB = 0x13  # Register for inputs on B
     GPPUA = 0x0C  # internal pull up on A
     GPPUB = 0x0D  # internal pull up on B
+    GPINTENA = 0x04  # interrupt on change enable for A
+    GPINTENB = 0x05  # interrupt on change enable for B
+    DEFVALA = 0x06  # default compare value for A
+    DEFVALB = 0x07  # default compare value for B
+    INTCONA = 0x08  # interrupt compare control for A
+    INTCONB = 0x09  # interrupt compare control for B
+    INTFA = 0x0E  # interrupt flags for A
+    INTFB = 0x0F  # interrupt flags for B
+    INTCAPA = 0x10  # pin levels captured at interrupt on A
+    INTCAPB = 0x11  # pin levels captured at interrupt on B
+    IOCON = 0x0A  # configuration register (BANK = 0 address)
+
+    IOCON_BANK = 0x80  # registers split into separate banks when set
+    IOCON_SEQOP = 0x20  # sequential addressing disabled when set
+
+    @classmethod
+    def configure(cls, bus, addr):
+        '''
+        keep the paired register layout and sequential addressing enabled
+        so both ports can be moved in a single block transaction
+        '''
+        iocon = Data(bus, addr, cls.IOCON)
+        cur = iocon.read()
+        new = cur & ~(cls.IOCON_BANK | cls.IOCON_SEQOP)
+        if new != cur:
+            iocon.write(new)
 
     @classmethod
-    def create(cls, bus, addr):
-        if not isinstance(bus, smbus.SMBus):
+    def create(cls, bus, addr, read=True):
+        '''
+        read=False builds it without touching the device,
+        a device powering up later starts in the expected layout
+        '''
+        if not is_bus(bus):
             raise ValueError("bus must be a SMBus instance")
+        if read:
+            cls.configure(bus, addr)
         return IOGroup(
             "MCP23017",
             bus,
             addr,
             [
-                IO(bus, addr, cls.IODIRA, cls.GPIOA, cls.OLATA, cls.GPPUA),
-                IO(bus, addr, cls.IODIRB, cls.GPIOB, cls.OLATB, cls.GPPUB)])
+                IO(
+                    bus, addr, cls.IODIRA, cls.GPIOA, cls.OLATA, cls.GPPUA,
+                    (
+                        cls.GPINTENA, cls.DEFVALA, cls.INTCONA,
+                        cls.INTFA, cls.INTCAPA),
+                    read),
+                IO(
+                    bus, addr, cls.IODIRB, cls.GPIOB, cls.OLATB, cls.GPPUB,
+                    (
+                        cls.GPINTENB, cls.DEFVALB, cls.INTCONB,
+                        cls.INTFB, cls.INTCAPB),
+                    read)],
+            {
+                "iodir": cls.IODIRA,
+                "gpio": cls.GPIOA,
+                "olat": cls.OLATA,
+                "pullup": cls.GPPUA,
+                "intf": cls.INTFA,
+                "intcap": cls.INTCAPA},
+            cls.IOCON)
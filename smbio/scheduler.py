@@ -0,0 +1,198 @@
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+# priority classes, lower runs first
+SENSOR = 0
+KEYPAD = 1
+COSMETIC = 2
+
+PRIORITIES = {
+    SENSOR: "sensor",
+    KEYPAD: "keypad",
+    COSMETIC: "cosmetic"}
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    '''run the bus transactions made by this thread at level'''
+    prev = getattr(_local, "priority", None)
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = prev
+
+
+@contextmanager
+def posting():
+    '''
+    queue the writes made by this thread and return without waiting,
+    a failed write is raised by the next transaction to that address
+    '''
+    prev = getattr(_local, "posting", False)
+    _local.posting = True
+    try:
+        yield
+    finally:
+        _local.posting = prev
+
+
+def current_priority(default=COSMETIC):
+    level = getattr(_local, "priority", None)
+    if level is None:
+        return default
+    return level
+
+
+class Transaction:
+
+    def __init__(self, level, func, args, addr=None, posted=False):
+        self.level = level
+        self.func = func
+        self.args = args
+        self.addr = addr
+        self.posted = posted
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Scheduler:
+    '''
+    Owns a bus handle and runs every transaction on it from one worker
+    thread, queued by the priority class of the calling thread
+
+    writes made under posting() return once queued, a later transaction
+    to the same address is held back until they have run so it sees
+    them, other addresses may overtake them
+
+    provides the same methods as the bus it wraps
+    '''
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.pending = {}  # addr: levels of its queued posted writes
+        self.errors = {}  # addr: error of a failed posted write
+        self.reset_stats()
+        self._running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset_stats(self):
+        self.stats = {
+            level: {"count": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for level in PRIORITIES}
+        self.depth_max = 0
+        self.posted = 0
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def report(self):
+        '''queue depth and per class wait times in ms'''
+        classes = {}
+        for level, stat in self.stats.items():
+            count = stat["count"]
+            classes[PRIORITIES[level]] = {
+                "count": count,
+                "wait_avg": stat["wait_total"] / count * 1000 if count else 0,
+                "wait_max": stat["wait_max"] * 1000}
+        return {
+            "depth": self.queue_depth(),
+            "depth_max": self.depth_max,
+            "posted": self.posted,
+            "classes": classes}
+
+    def submit(self, func, addr, *args, post=False):
+        level = current_priority()
+        with self.cond:
+            if not self._running:
+                raise RuntimeError("bus scheduler is closed")
+            error = self.errors.pop(addr, None)
+            if error is not None:
+                raise error
+            pending = self.pending.get(addr)
+            if post:
+                self.pending.setdefault(addr, []).append(level)
+                self.posted += 1
+            elif pending:
+                # run after the posted writes to this address
+                level = max(level, max(pending))
+            transaction = Transaction(level, func, (addr,) + args, addr, post)
+            heapq.heappush(
+                self.queue,
+                (transaction.level, next(self.seq), transaction))
+            if len(self.queue) > self.depth_max:
+                self.depth_max = len(self.queue)
+            self.cond.notify()
+        if post:
+            return None
+        transaction.done.wait()
+        if transaction.error is not None:
+            raise transaction.error
+        return transaction.result
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self._running and not self.queue:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                level, seq, transaction = heapq.heappop(self.queue)
+            wait = time.monotonic() - transaction.queued
+            stat = self.stats[level]
+            stat["count"] += 1
+            stat["wait_total"] += wait
+            if wait > stat["wait_max"]:
+                stat["wait_max"] = wait
+            try:
+                transaction.result = transaction.func(*transaction.args)
+            except Exception as err:
+                transaction.error = err
+            if transaction.posted:
+                with self.cond:
+                    pending = self.pending[transaction.addr]
+                    pending.remove(level)
+                    if not pending:
+                        del self.pending[transaction.addr]
+                    if transaction.error is not None:
+                        self.errors.setdefault(
+                            transaction.addr, transaction.error)
+            transaction.done.set()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def read_byte_data(self, addr, reg):
+        return self.submit(self.bus.read_byte_data, addr, reg)
+
+    def write_byte_data(self, addr, reg, value):
+        return self.submit(
+            self.bus.write_byte_data, addr, reg, value,
+            post=getattr(_local, "posting", False))
+
+    def read_i2c_block_data(self, addr, reg, length=32):
+        return self.submit(self.bus.read_i2c_block_data, addr, reg, length)
+
+    def write_i2c_block_data(self, addr, reg, values):
+        return self.submit(
+            self.bus.write_i2c_block_data, addr, reg, list(values),
+            post=getattr(_local, "posting", False))
+
+    def close(self):
+        with self.cond:
+            self._running = False
+            self.cond.notify()
+        self.thread.join()
+        if hasattr(self.bus, "close"):
+            self.bus.close()
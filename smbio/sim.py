@@ -0,0 +1,322 @@
+import os
+import time
+import errno
+import threading
+from collections import Counter
+
+
+class MCP230xx:
+    '''
+    Register model of a MCP230xx port expander
+
+    PORTS maps each register of a port to its address,
+    input pins are driven from outside with drive()
+    '''
+
+    PORTS = []
+    IOCON = []
+    SIZE = 0
+    TOGGLE = False  # byte mode toggles between the A/B pair
+
+    IOCON_SEQOP = 0x20
+
+    def __init__(self):
+        self.iocon = 0x00
+        self.ports = []
+        for _ in self.PORTS:
+            self.ports.append({
+                "iodir": 0xff,
+                "ipol": 0x00,
+                "gpinten": 0x00,
+                "defval": 0x00,
+                "intcon": 0x00,
+                "gppu": 0x00,
+                "intf": 0x00,
+                "intcap": 0x00,
+                "olat": 0x00,
+                "pins": 0x00,
+                "driven": 0x00})
+        self.regmap = {}
+        for port, regs in enumerate(self.PORTS):
+            for name, reg in regs.items():
+                self.regmap[reg] = (port, name)
+
+    def gpio(self, port):
+        '''input pins that were never driven float to their pull up'''
+        p = self.ports[port]
+        levels = (p["pins"] & p["driven"]) | (p["gppu"] & ~p["driven"])
+        return ((levels ^ p["ipol"]) & p["iodir"]) | (
+            p["olat"] & ~p["iodir"] & 0xff)
+
+    def read(self, reg):
+        if reg in self.IOCON:
+            return self.iocon
+        if reg not in self.regmap:
+            return 0x00
+        port, name = self.regmap[reg]
+        p = self.ports[port]
+        if name == "gpio":
+            p["intf"] = 0x00
+            return self.gpio(port)
+        if name == "intcap":
+            p["intf"] = 0x00
+        return p[name]
+
+    def write(self, reg, value):
+        value &= 0xff
+        if reg in self.IOCON:
+            self.iocon = value
+            return
+        if reg not in self.regmap:
+            return
+        port, name = self.regmap[reg]
+        if name == "intf" or name == "intcap":
+            return  # read only
+        if name == "gpio":
+            name = "olat"
+        self.ports[port][name] = value
+
+    def next_reg(self, reg):
+        if not self.iocon & MCP230xx.IOCON_SEQOP:
+            return (reg + 1) % self.SIZE
+        if self.TOGGLE:
+            return reg ^ 1
+        return reg
+
+    def drive(self, port, pin, level):
+        '''set the level applied to an input pin'''
+        p = self.ports[port]
+        old = self.gpio(port)
+        p["driven"] |= 1 << pin
+        if level:
+            p["pins"] |= 1 << pin
+        else:
+            p["pins"] &= ~(1 << pin)
+        new = self.gpio(port)
+        enabled = p["gpinten"] & p["iodir"]
+        on_change = (old ^ new) & ~p["intcon"]
+        on_compare = (new ^ p["defval"]) & p["intcon"]
+        flags = (on_change | on_compare) & enabled
+        if flags:
+            if not p["intf"]:
+                p["intcap"] = new
+            p["intf"] |= flags
+
+    def interrupt(self):
+        '''True while the INT output is asserted'''
+        return any(p["intf"] for p in self.ports)
+
+
+class MCP23008(MCP230xx):
+
+    PORTS = [{
+        "iodir": 0x00,
+        "ipol": 0x01,
+        "gpinten": 0x02,
+        "defval": 0x03,
+        "intcon": 0x04,
+        "gppu": 0x06,
+        "intf": 0x07,
+        "intcap": 0x08,
+        "gpio": 0x09,
+        "olat": 0x0A}]
+    IOCON = [0x05]
+    SIZE = 0x0B
+
+
+class MCP23017(MCP230xx):
+    '''register model with IOCON.BANK = 0'''
+
+    PORTS = [
+        {
+            "iodir": 0x00,
+            "ipol": 0x02,
+            "gpinten": 0x04,
+            "defval": 0x06,
+            "intcon": 0x08,
+            "gppu": 0x0C,
+            "intf": 0x0E,
+            "intcap": 0x10,
+            "gpio": 0x12,
+            "olat": 0x14},
+        {
+            "iodir": 0x01,
+            "ipol": 0x03,
+            "gpinten": 0x05,
+            "defval": 0x07,
+            "intcon": 0x09,
+            "gppu": 0x0D,
+            "intf": 0x0F,
+            "intcap": 0x11,
+            "gpio": 0x13,
+            "olat": 0x15}]
+    IOCON = [0x0A, 0x0B]
+    SIZE = 0x16
+    TOGGLE = True
+
+
+class SimBus:
+    '''
+    In memory stand in for smbus.SMBus
+
+    counts reads and writes per (addr, register),
+    a block transaction counts once against its first register,
+    latency is slept on every transaction
+    '''
+
+    CHANGED = threading.Condition()  # notified when any input is driven
+    LINES = []  # SimLines told about every drive
+
+    def __init__(self, bus=0, latency=0):
+        self.bus = bus
+        self.latency = latency
+        self.devices = {}
+        self.failing = {}
+        self.reads = Counter()
+        self.writes = Counter()
+        self.lock = threading.RLock()
+
+    def attach(self, addr, device):
+        self.devices[addr] = device
+
+    def fail(self, addr, count=None):
+        '''
+        make the next count transactions to addr raise an IOError,
+        every transaction until heal when count is None
+        '''
+        self.failing[addr] = count
+
+    def heal(self, addr):
+        self.failing.pop(addr, None)
+
+    def device(self, addr):
+        if addr in self.failing:
+            count = self.failing[addr]
+            if count is not None:
+                if count <= 1:
+                    del self.failing[addr]
+                else:
+                    self.failing[addr] = count - 1
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        if addr not in self.devices:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        return self.devices[addr]
+
+    def transaction(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def read_byte_data(self, addr, reg):
+        self.transaction()
+        with self.lock:
+            self.reads[(addr, reg)] += 1
+            return self.device(addr).read(reg)
+
+    def write_byte_data(self, addr, reg, value):
+        self.transaction()
+        with self.lock:
+            self.writes[(addr, reg)] += 1
+            self.device(addr).write(reg, value)
+
+    def read_i2c_block_data(self, addr, reg, length=32):
+        self.transaction()
+        with self.lock:
+            self.reads[(addr, reg)] += 1
+            device = self.device(addr)
+            values = []
+            for _ in range(length):
+                values.append(device.read(reg))
+                reg = device.next_reg(reg)
+            return values
+
+    def write_i2c_block_data(self, addr, reg, values):
+        self.transaction()
+        with self.lock:
+            self.writes[(addr, reg)] += 1
+            device = self.device(addr)
+            for value in values:
+                device.write(reg, value)
+                reg = device.next_reg(reg)
+
+    def drive(self, addr, port, pin, level):
+        '''set the level applied to an input pin of the device at addr'''
+        with SimBus.CHANGED:
+            with self.lock:
+                self.device(addr).drive(port, pin, level)
+            SimBus.CHANGED.notify_all()
+            for line in SimBus.LINES:
+                line.notify()
+
+    def interrupt(self):
+        with self.lock:
+            return any(
+                device.interrupt() for device in self.devices.values())
+
+    def transactions(self, addr=None):
+        '''total reads and writes, optionally only for one address'''
+        total = 0
+        for counter in (self.reads, self.writes):
+            for key, count in counter.items():
+                if addr is None or key[0] == addr:
+                    total += count
+        return total
+
+    def reset_counters(self):
+        with self.lock:
+            self.reads.clear()
+            self.writes.clear()
+
+    def close(self):
+        pass
+
+
+class SimLine:
+    '''stand in for gpio.EventLine driven by the INT state of SimBuses'''
+
+    def __init__(self, buses):
+        self.buses = list(buses)
+        # a pipe written on every asserted drive gives the line a fileno
+        self.r, self.w = os.pipe()
+        os.set_blocking(self.r, False)
+        os.set_blocking(self.w, False)
+        with SimBus.CHANGED:
+            SimBus.LINES.append(self)
+
+    def fileno(self):
+        return self.r
+
+    def interrupt(self):
+        return any(bus.interrupt() for bus in self.buses)
+
+    def notify(self):
+        if self.interrupt():
+            try:
+                os.write(self.w, b"\0")
+            except BlockingIOError:
+                pass
+
+    def drain(self):
+        '''discard queued events, returns True if there were any'''
+        got = False
+        while True:
+            try:
+                data = os.read(self.r, 64)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            got = True
+        return got
+
+    def wait(self, timeout):
+        with SimBus.CHANGED:
+            return SimBus.CHANGED.wait_for(self.interrupt, timeout)
+
+    def close(self):
+        with SimBus.CHANGED:
+            if self in SimBus.LINES:
+                SimBus.LINES.remove(self)
+        if self.r is not None:
+            os.close(self.r)
+            os.close(self.w)
+            self.r = self.w = None
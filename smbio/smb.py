@@ -1,9 +1,37 @@
-import smbus
+import math
+import time
 import warnings
 import copy
-
-
-def Bus(bus):
+from collections import deque
+from . import sim
+from . import scheduler
+from .debounce import Debouncer
+from .timer import Timers
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
+
+# methods a bus object must provide, smbus.SMBus and sim.SimBus both do
+BUS_METHODS = (
+    "read_byte_data",
+    "write_byte_data",
+    "read_i2c_block_data",
+    "write_i2c_block_data")
+
+
+def is_bus(bus):
+    return all(callable(getattr(bus, name, None)) for name in BUS_METHODS)
+
+
+def Bus(bus, backend="smbus"):
+    if backend == "sim":
+        return sim.SimBus(bus)
+    if backend != "smbus":
+        raise ValueError("unknown bus backend: {}".format(backend))
+    if smbus is None:
+        raise RuntimeError("the smbus module is not installed")
     return smbus.SMBus(bus)
 
 
@@ -11,6 +39,10 @@ class Peripheral:
     '''Create a SMB Peripheral interface'''
 
     DIRECTION = 0
+    EDGE = False  # fed with change() when its pin changes instead of polled
+    POLL = True  # False when it only reacts to state, messages and timers
+    PRIORITY = scheduler.COSMETIC
+    SUBSCRIBES = ()  # message topics handed to process_messages()
     DATAMAP = {
         "desc": "str"}
 
@@ -18,7 +50,7 @@ class Peripheral:
     def datamap(cls):
         return copy.copy(Peripheral.DATAMAP)
 
-    def __init__(self, pid, io, data=None):
+    def __init__(self, pid, io, data=None, timers=None):
         if not isinstance(io, IO):
             raise ValueError("io must be an IO instace")
         if "desc" in data:
@@ -29,16 +61,22 @@ class Peripheral:
         self.pid = pid
         self.data = data
         self._state = 0
+        if timers is None:
+            timers = Timers()  # standalone, the caller runs timers.run()
+        self.timers = timers
         self.init()
-        self.message_q = []
+        self.message_q = deque()
 
-    def message(self, message):
-        self.message_q.append(message)
+    def message(self, message, target=None):
+        '''
+        queue a message for every interface subscribed to it,
+        or only for interface target
+        '''
+        self.message_q.append((message, target))
 
     def pull_messages(self):
-        msgs = []
-        while self.message_q:
-            msgs.append(self.message_q.pop(0))
+        msgs = list(self.message_q)
+        self.message_q.clear()
         return msgs
 
     def process_messages(self, messages):
@@ -47,6 +85,10 @@ class Peripheral:
     def init(self):
         pass
 
+    def scanning(self):
+        '''True while the peripheral needs another tick straight away'''
+        return False
+
     def get_state(self):
         return self._state
 
@@ -56,6 +98,9 @@ class Peripheral:
     def update(self):
         pass
 
+    def change(self, level):
+        return {}
+
 
 class Data:
     '''
@@ -65,7 +110,7 @@ class Data:
     '''
 
     def __init__(self, bus, addr, com, offset=0, length=8):
-        if not isinstance(bus, smbus.SMBus):
+        if not is_bus(bus):
             raise ValueError("bus must be a SMBus instance")
         self.bus = bus
         self.addr = addr
@@ -85,15 +130,75 @@ class Data:
         return value >> self.offset
 
 
+class Block:
+    '''
+    Create a data interface to a run of sequential registers
+    starting at address com, read and written in one transaction
+    '''
+
+    def __init__(self, bus, addr, com, length):
+        if not is_bus(bus):
+            raise ValueError("bus must be a SMBus instance")
+        self.bus = bus
+        self.addr = addr
+        self.com = com
+        self.length = length
+
+    def write(self, values):
+        values = list(values)
+        if len(values) != self.length:
+            raise ValueError(
+                "must write exactly {} values".format(self.length))
+        for value in values:
+            if not isinstance(value, int) or value.bit_length() > 8:
+                raise ValueError(
+                    "can only write ints with a bit length "
+                    "smaller than 8")
+        self.bus.write_i2c_block_data(self.addr, self.com, values)
+
+    def read(self):
+        values = self.bus.read_i2c_block_data(self.addr, self.com, self.length)
+        return [value & 0xff for value in values]
+
+
 class IO:
-    '''Define an interface to an 8 bit IO'''
+    '''
+    Define an interface to an 8 bit IO
+
+    register values are kept in shadows and served from them,
+    the hardware is only read back when verifying
+
+    in deferred mode writes only update the shadows and mark them dirty
+    until flush writes each changed register out once
+    '''
     READ = 1
     WRITE = 0
     PINMIN = 0
     PINMAX = 7
 
-    def __init__(self, bus, addr, iodir, gpio, olat, pullup):
-        if not isinstance(bus, smbus.SMBus):
+    DIRTY_OLAT = 0x1
+    DIRTY_IODIR = 0x2
+    DIRTY_PULLUP = 0x4
+    DIRTY_ALL = DIRTY_OLAT | DIRTY_IODIR | DIRTY_PULLUP
+
+    VERIFY_NEVER = 0
+    VERIFY_WRITES = 1
+    VERIFY_TIMER = 2
+
+    VERIFY = {
+        "never": VERIFY_NEVER,
+        "writes": VERIFY_WRITES,
+        "timer": VERIFY_TIMER}
+
+    def __init__(self, bus, addr, iodir, gpio, olat, pullup, interrupt=None,
+                 read=True):
+        '''
+        interrupt is an optional tuple of the
+        (gpinten, defval, intcon, intf, intcap) registers,
+        without read the shadows start at the power on values
+        and are all dirty instead of being read from the device
+        '''
+        if not is_bus(bus):
             raise ValueError("bus must be an SMBus instance")
         self.bus = bus
         self.addr = addr
@@ -101,15 +206,66 @@ class IO:
         self.olat = Data(bus, self.addr, olat)
         self.gpio = Data(bus, self.addr, gpio)
         self.pullup = Data(bus, self.addr, pullup)
-        self.iodir_val = self.get_mode()
-        self.gpio_val = self.read_in()
-        self.olat_val = self.read_out()
-        self.pullup_val = self.get_pullup()
-
-    def reset(self):
-        self.iodir.write(0xff)
-        self.pullup.write(0x00)
-        self.olat.write(0x00)
+        self.gpinten = None
+        if interrupt is not None:
+            gpinten, defval, intcon, intf, intcap = interrupt
+            self.gpinten = Data(bus, self.addr, gpinten)
+            self.defval = Data(bus, self.addr, defval)
+            self.intcon = Data(bus, self.addr, intcon)
+            self.intf = Data(bus, self.addr, intf)
+            self.intcap = Data(bus, self.addr, intcap)
+        self.gpinten_val = 0x00
+        if read:
+            self.iodir_val = self.iodir.read()
+            self.gpio_val = self.read_in()
+            self.olat_val = self.olat.read()
+            self.pullup_val = self.pullup.read()
+        else:
+            self.iodir_val = 0xff
+            self.gpio_val = 0x00
+            self.olat_val = 0x00
+            self.pullup_val = 0x00
+        self.changed = 0x00
+        self.verify_policy = IO.VERIFY_NEVER
+        self.verify_every = 0
+        self.verify_count = 0
+        self.verify_last = time.monotonic()
+        self.sampling = False
+        self.sample_mask = 0x00  # pins an interface samples
+        self.debouncer = None
+        self.debounce_ms = {}  # pin: milliseconds
+        self.sample_interval = 0.01
+        self.deferred = False
+        self.dirty = 0 if read else IO.DIRTY_ALL
+
+    def reset(self, flush=True):
+        self.iodir_val = 0xff
+        self.pullup_val = 0x00
+        self.olat_val = 0x00
+        self.dirty = IO.DIRTY_ALL
+        if flush:
+            self.flush()
+
+    def set_deferred(self, deferred):
+        self.deferred = deferred
+        if not deferred:
+            self.flush()
+
+    def flush(self):
+        '''write every dirty register out to the device'''
+        dirty = self.dirty
+        if not dirty:
+            return
+        self.dirty = 0
+        count = 0
+        for flag, reg, value in (
+                (IO.DIRTY_OLAT, self.olat, self.olat_val),
+                (IO.DIRTY_IODIR, self.iodir, self.iodir_val),
+                (IO.DIRTY_PULLUP, self.pullup, self.pullup_val)):
+            if dirty & flag:
+                reg.write(value)
+                count += 1
+        self.written(count)
 
     def __check_value(self, value, pin=False):
         if not isinstance(value, int):
@@ -133,23 +289,69 @@ class IO:
             raise ValueError(
                 "pin must be between {} and {}".format(IO.PINMAX, IO.PINMIN))
 
+    def set_verify(self, policy, every=0):
+        '''
+        set how the shadows are checked against the hardware
+        every is a number of writes for VERIFY_WRITES
+        and a number of seconds for VERIFY_TIMER
+        '''
+        if policy not in IO.VERIFY.values():
+            raise ValueError("unknown verify policy: {}".format(policy))
+        if policy != IO.VERIFY_NEVER and every <= 0:
+            raise ValueError("every must be greater than 0")
+        self.verify_policy = policy
+        self.verify_every = every
+        self.verify_count = 0
+        self.verify_last = time.monotonic()
+
+    def verify(self):
+        '''read back the registers and restore any that do not match'''
+        self.verify_count = 0
+        self.verify_last = time.monotonic()
+        for flag, reg, where in (
+                (IO.DIRTY_IODIR, self.iodir, 'iodir'),
+                (IO.DIRTY_PULLUP, self.pullup, 'pullup'),
+                (IO.DIRTY_OLAT, self.olat, 'olat')):
+            if self.dirty & flag:
+                continue
+            expected = getattr(self, where + '_val')
+            got = reg.read()
+            if got != expected:
+                self.warn(got, expected, where)
+                reg.write(expected)
+
+    def poll_verify(self):
+        if self.verify_policy == IO.VERIFY_TIMER:
+            if time.monotonic() - self.verify_last >= self.verify_every:
+                self.verify()
+
+    def written(self, count=1):
+        '''record register writes for the verify policy'''
+        if self.verify_policy == IO.VERIFY_WRITES:
+            self.verify_count += count
+            if self.verify_count >= self.verify_every:
+                self.verify()
+
     def write_out(self, value):
         self.__check_value(value)
+        if self.deferred:
+            if value != self.olat_val:
+                self.olat_val = value
+                self.dirty |= IO.DIRTY_OLAT
+            return
         self.olat.write(value)
         self.olat_val = value
+        self.written()
 
     def write_out_pin(self, pin, value):
         self.__check_pin(pin)
         self.__check_value(value, True)
-        cur = self.read_out()
-        if cur != self.olat_val:
-            self.warn(cur, self.olat_val, 'olat')
-            cur = self.olat_val
+        cur = self.olat_val
         new = cur ^ ((-value ^ cur) & (1 << pin))
         self.write_out(new)
 
     def read_out(self):
-        return self.olat.read()
+        return self.olat_val
 
     def read_out_pin(self, pin):
         self.__check_pin(pin)
@@ -164,23 +366,116 @@ class IO:
         cur = self.read_in()
         return (cur >> pin) & 1
 
+    def enable_sampling(self, mask=0xff):
+        '''
+        include this IO in the snapshot taken by IOGroup.sample,
+        mask holds the pins the caller reads from it
+        '''
+        self.__check_value(mask)
+        self.sampling = True
+        self.sample_mask |= mask
+
+    def set_debounce(self, pin, ms):
+        '''make pin hold a level for ms milliseconds before it is seen'''
+        self.__check_pin(pin)
+        if ms > 0:
+            self.debounce_ms[pin] = ms
+        else:
+            self.debounce_ms.pop(pin, None)
+        self.__set_window(pin)
+
+    def set_sample_interval(self, interval):
+        '''seconds between samples, the debounce windows count them'''
+        if interval == self.sample_interval:
+            return
+        self.sample_interval = interval
+        for pin in self.debounce_ms:
+            self.__set_window(pin)
+
+    def __set_window(self, pin):
+        ms = self.debounce_ms.get(pin, 0)
+        window = 1
+        if ms > 0:
+            # the first and last sample of the window are ms apart
+            window = math.ceil(ms / (self.sample_interval * 1000)) + 1
+        if self.debouncer is None:
+            if window <= 1:
+                return
+            self.debouncer = Debouncer()
+        self.debouncer.set_window(pin, window)
+
+    def settling(self):
+        '''pins still being debounced'''
+        if self.debouncer is None:
+            return 0x00
+        return self.debouncer.settling
+
+    def sample(self, value=None, flags=0x00, captured=0x00):
+        '''
+        store a GPIO snapshot, pins in flags take their level from
+        captured so an edge latched by an interrupt is seen for one sample
+        even if the pin has already returned to its old level
+        '''
+        if value is None:
+            value = self.read_in()
+        value = (value & ~flags) | (captured & flags)
+        if self.debouncer is not None:
+            value = self.debouncer.update(value)
+        self.changed |= self.gpio_val ^ value
+        self.gpio_val = value
+        return self.gpio_val
+
+    def read_sample(self):
+        return self.gpio_val
+
+    def read_sample_pin(self, pin):
+        self.__check_pin(pin)
+        cur = self.read_sample()
+        return (cur >> pin) & 1
+
+    def enable_interrupts(self, mask):
+        '''raise an interrupt on any change of the pins in mask'''
+        if self.gpinten is None:
+            raise RuntimeError(
+                "IO at addr {} has no interrupt registers".format(
+                    hex(self.addr)))
+        self.__check_value(mask)
+        self.defval.write(0x00)
+        self.intcon.write(0x00)  # compare against the previous pin level
+        self.gpinten.write(mask)
+        self.gpinten_val = mask
+
+    def read_interrupt(self):
+        '''
+        return the pins that raised an interrupt and their captured levels
+        '''
+        if not self.gpinten_val:
+            return 0x00, 0x00
+        flags = self.intf.read()
+        if not flags:
+            return 0x00, 0x00
+        return flags, self.intcap.read()
+
     def set_mode(self, mode):
         self.__check_value(mode)
+        if self.deferred:
+            if mode != self.iodir_val:
+                self.iodir_val = mode
+                self.dirty |= IO.DIRTY_IODIR
+            return
         self.iodir.write(mode)
         self.iodir_val = mode
+        self.written()
 
     def set_mode_pin(self, pin, mode):
         self.__check_pin(pin)
         self.__check_mode(mode)
-        cur = self.get_mode()
-        if cur != self.iodir_val:
-            self.warn(cur, self.iodir_val, 'iodir')
-            cur = self.iodir_val
+        cur = self.iodir_val
         new = cur ^ ((-mode ^ cur) & (1 << pin))
         self.set_mode(new)
 
     def get_mode(self):
-        return self.iodir.read()
+        return self.iodir_val
 
     def get_mode_pin(self, pin):
         self.__check_pin(pin)
@@ -189,21 +484,24 @@ class IO:
 
     def set_pullup(self, mode):
         self.__check_value(mode)
+        if self.deferred:
+            if mode != self.pullup_val:
+                self.pullup_val = mode
+                self.dirty |= IO.DIRTY_PULLUP
+            return
         self.pullup.write(mode)
         self.pullup_val = mode
+        self.written()
 
     def set_pullup_pin(self, pin, mode):
         self.__check_pin(pin)
         self.__check_mode(mode)
-        cur = self.get_pullup()
-        if cur != self.pullup_val:
-            self.warn(cur, self.pullup_val, 'pullup')
-            cur = self.pullup_val
+        cur = self.pullup_val
         new = cur ^ ((-mode ^ cur) & (1 << pin))
         self.set_pullup(new)
 
     def get_pullup(self):
-        return self.pullup.read()
+        return self.pullup_val
 
     def get_pullup_pin(self, pin):
         self.__check_pin(pin)
@@ -223,14 +521,42 @@ class IO:
 
 
 class IOGroup:
+    '''
+    A device made of one or more IOs,
+    blocks maps a register name (gpio, iodir, olat, pullup) to the
+    first of a run of sequential registers covering every IO in order
+    so the whole device can be sampled or flushed in one transaction
+    '''
+
+    REGISTERS = (
+        ("olat", IO.DIRTY_OLAT),
+        ("iodir", IO.DIRTY_IODIR),
+        ("pullup", IO.DIRTY_PULLUP))
 
-    def __init__(self, name, bus, addr, ios):
+    IOCON_MIRROR = 0x40  # one INT output for every port
+    IOCON_ODR = 0x04  # INT output is open drain
+
+    def __init__(self, name, bus, addr, ios, blocks=None, iocon=None):
         self.name = name
-        if not isinstance(bus, smbus.SMBus):
+        if not is_bus(bus):
             raise ValueError("bus must be a SMBus instance")
         self.bus = bus
         self.addr = addr
         self.ios = ios
+        self.blocks = {}
+        if blocks:
+            for reg, com in blocks.items():
+                self.blocks[reg] = Block(bus, addr, com, len(ios))
+        self.iocon = None
+        if iocon is not None:
+            self.iocon = Data(bus, addr, iocon)
+        self.interrupts = False
+        self.fail_threshold = 3
+        self.backoff = 1.0
+        self.backoff_max = 60.0
+        self.failures = 0
+        self.degraded = False
+        self.retry_at = 0
 
     def __iter__(self):
         for io in self.ios:
@@ -241,4 +567,173 @@ class IOGroup:
 
     def reset(self):
         for io in self.ios:
-            io.reset()
+            io.reset(False)
+        self.flush()
+
+    def set_deferred(self, deferred):
+        for io in self.ios:
+            io.deferred = deferred
+        if not deferred:
+            self.flush()
+
+    def enable_interrupts(self, open_drain=False):
+        '''
+        raise an interrupt on any change of a sampled input pin,
+        unused inputs are left out so noise on them does not wake the loop
+        '''
+        if self.iocon is None:
+            raise RuntimeError("{} at addr {} has no interrupts".format(
+                self.name, hex(self.addr)))
+        cur = self.iocon.read()
+        new = cur | IOGroup.IOCON_MIRROR
+        if open_drain:
+            new |= IOGroup.IOCON_ODR
+        else:
+            new &= ~IOGroup.IOCON_ODR
+        if new != cur:
+            self.iocon.write(new)
+        for io in self.ios:
+            if io.sampling:
+                io.enable_interrupts(io.sample_mask & io.iodir_val)
+        self.interrupts = True
+
+    def read_interrupts(self):
+        '''return a (flags, captured) pair for every IO'''
+        if "intf" in self.blocks:
+            flags = self.blocks["intf"].read()
+            if any(flags):
+                return list(zip(flags, self.blocks["intcap"].read()))
+            return [(0x00, 0x00)] * len(self.ios)
+        return [io.read_interrupt() for io in self.ios]
+
+    def sample(self):
+        '''
+        take one GPIO snapshot of every IO that has sampling enabled,
+        with interrupts enabled the latched captures are read first and
+        merged in since reading GPIO clears them, whatever woke the loop.
+        returns True if any latched edge was merged
+        '''
+        if self.interrupts:
+            latched = self.read_interrupts()
+        else:
+            latched = [(0x00, 0x00)] * len(self.ios)
+        if "gpio" in self.blocks:
+            if any(io.sampling for io in self.ios):
+                values = self.blocks["gpio"].read()
+                for io, value, (flags, captured) in zip(
+                        self.ios, values, latched):
+                    if io.sampling:
+                        io.sample(value, flags, captured)
+        else:
+            for io, (flags, captured) in zip(self.ios, latched):
+                if io.sampling:
+                    io.sample(None, flags, captured)
+        return any(flags for flags, captured in latched)
+
+    def gpio_reads(self):
+        '''(register, count) reads that fetch the GPIO port of every IO'''
+        if "gpio" in self.blocks:
+            return [(self.blocks["gpio"].com, self.blocks["gpio"].length)]
+        return [(io.gpio.com, 1) for io in self.ios]
+
+    def feed(self, values):
+        '''
+        sample GPIO values read elsewhere, one for every IO,
+        returns True if a sampled pin changed
+        '''
+        changed = False
+        for io, value in zip(self.ios, values):
+            if io.sampling:
+                old = io.gpio_val
+                if io.sample(value) != old:
+                    changed = True
+        return changed
+
+    def flush(self):
+        '''
+        write the dirty registers of every IO out to the device,
+        a register dirty on any IO is written for all of them in one block
+        '''
+        if not self.blocks:
+            for io in self.ios:
+                io.flush()
+            return
+        dirty = 0
+        for io in self.ios:
+            dirty |= io.dirty
+        if not dirty:
+            return
+        for io in self.ios:
+            io.dirty = 0
+        count = 0
+        for reg, flag in IOGroup.REGISTERS:
+            if dirty & flag:
+                self.blocks[reg].write(
+                    [getattr(io, reg + "_val") for io in self.ios])
+                count += 1
+        for io in self.ios:
+            io.written(count)
+
+    def set_health(self, threshold, backoff, backoff_max):
+        '''
+        degrade the device after threshold failures in a row,
+        then retry it after backoff seconds doubling up to backoff_max
+        '''
+        self.fail_threshold = threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+    def failed(self, now):
+        '''record a failure, returns True if the device just degraded'''
+        self.failures += 1
+        if self.failures < self.fail_threshold:
+            return False
+        # capped so a device dead for days cannot overflow the delay
+        exponent = min(self.failures - self.fail_threshold, 32)
+        delay = self.backoff * 2 ** exponent
+        self.retry_at = now + min(delay, self.backoff_max)
+        if self.degraded:
+            return False
+        self.degraded = True
+        return True
+
+    def degrade(self, now):
+        '''mark a device that did not answer at all as degraded'''
+        self.failures = max(self.failures, self.fail_threshold - 1)
+        return self.failed(now)
+
+    def recovered(self):
+        '''record a success, returns True if the device was degraded'''
+        self.failures = 0
+        if not self.degraded:
+            return False
+        self.degraded = False
+        return True
+
+    def settling(self):
+        return any(io.settling() for io in self.ios)
+
+    def retry_due(self, now):
+        return self.degraded and now >= self.retry_at
+
+    def probe(self):
+        '''
+        check a degraded device answers, then write every shadowed register
+        back in case it lost its state while unreachable
+        '''
+        self.ios[0].iodir.read()
+        for io in self.ios:
+            io.dirty = IO.DIRTY_ALL
+        self.flush()
+
+    def set_sample_interval(self, interval):
+        for io in self.ios:
+            io.set_sample_interval(interval)
+
+    def set_verify(self, policy, every=0):
+        for io in self.ios:
+            io.set_verify(policy, every)
+
+    def poll_verify(self):
+        for io in self.ios:
+            io.poll_verify()
@@ -0,0 +1,108 @@
+import os
+import time
+import heapq
+import select
+import itertools
+
+
+class Timer:
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers:
+    '''
+    Heap of deadlines on the monotonic clock shared by peripherals,
+    callbacks are only run from run() once their deadline has passed
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+
+    def call_at(self, deadline, callback):
+        timer = Timer(deadline, callback)
+        heapq.heappush(self.heap, (deadline, next(self.seq), timer))
+        return timer
+
+    def call_later(self, delay, callback):
+        '''run callback after delay seconds, returns a cancellable Timer'''
+        return self.call_at(self.clock() + delay, callback)
+
+    def next_deadline(self):
+        '''the earliest pending deadline or None'''
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def run(self):
+        '''run every expired callback, returns how many ran'''
+        ran = 0
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(self.heap)
+            if not timer.cancelled:
+                timer.callback()
+                ran += 1
+        return ran
+
+    def clear(self):
+        for deadline, seq, timer in self.heap:
+            timer.cancel()
+        self.heap = []
+
+
+class Waker:
+    '''
+    Self pipe a loop blocks on with select, wake() ends the wait
+    early from any thread, other objects with a fileno can be waited
+    on alongside it
+    '''
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        os.set_blocking(self.r, False)
+        os.set_blocking(self.w, False)
+
+    def fileno(self):
+        return self.r
+
+    def wake(self):
+        try:
+            os.write(self.w, b"\0")
+        except BlockingIOError:
+            pass  # already pending
+
+    def drain(self):
+        while True:
+            try:
+                if not os.read(self.r, 64):
+                    break
+            except BlockingIOError:
+                break
+
+    def wait(self, timeout, *others):
+        '''
+        block until woken, one of others is readable or timeout
+        seconds pass, returns the readable others
+        '''
+        ready = select.select([self] + list(others), [], [], timeout)[0]
+        if self in ready:
+            self.drain()
+            ready.remove(self)
+        return ready
+
+    def close(self):
+        if self.r is not None:
+            os.close(self.r)
+            os.close(self.w)
+            self.r = self.w = None
@@ -0,0 +1,95 @@
+import time
+import bisect
+
+# upper bounds of the latency histogram buckets in microseconds,
+# the last bucket counts everything slower
+BUCKETS = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000]
+
+METHODS = {
+    "read_byte_data": "reads",
+    "write_byte_data": "writes",
+    "read_i2c_block_data": "reads",
+    "write_i2c_block_data": "writes"}
+
+
+class TracedBus:
+    '''
+    Wraps a bus and records, per (addr, register), call counts,
+    a latency histogram and IOError counts while enabled
+
+    when disabled the bus methods are bound straight through
+    so tracing costs nothing
+    '''
+
+    def __init__(self, bus, name):
+        self.bus = bus
+        self.name = name
+        self.enabled = False
+        self.reset()
+        self.disable()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def enable(self):
+        for method, kind in METHODS.items():
+            setattr(self, method, self.traced(
+                getattr(self.bus, method), kind))
+        self.enabled = True
+
+    def disable(self):
+        for method in METHODS:
+            setattr(self, method, getattr(self.bus, method))
+        self.enabled = False
+
+    def reset(self):
+        self.stats = {}
+        self.since = time.time()
+
+    def entry(self, addr, reg):
+        key = (addr, reg)
+        if key not in self.stats:
+            self.stats[key] = {
+                "reads": 0,
+                "writes": 0,
+                "errors": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "hist": [0] * (len(BUCKETS) + 1)}
+        return self.stats[key]
+
+    def traced(self, func, kind):
+        def call(addr, reg, *args):
+            start = time.perf_counter()
+            try:
+                return func(addr, reg, *args)
+            except OSError:
+                self.entry(addr, reg)["errors"] += 1
+                raise
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000000
+                entry = self.entry(addr, reg)
+                entry[kind] += 1
+                entry["total"] += elapsed
+                if elapsed > entry["max"]:
+                    entry["max"] = elapsed
+                entry["hist"][bisect.bisect_left(BUCKETS, elapsed)] += 1
+        return call
+
+    def report(self):
+        '''stats keyed by "addr:register" in hex, times in microseconds'''
+        devices = {}
+        for (addr, reg), entry in list(self.stats.items()):
+            count = entry["reads"] + entry["writes"]
+            devices["{}:{}".format(hex(addr), hex(reg))] = {
+                "reads": entry["reads"],
+                "writes": entry["writes"],
+                "errors": entry["errors"],
+                "avg": entry["total"] / count if count else 0,
+                "max": entry["max"],
+                "hist": list(entry["hist"])}
+        return {
+            "enabled": self.enabled,
+            "since": self.since,
+            "buckets": BUCKETS,
+            "devices": devices}
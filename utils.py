@@ -2,6 +2,8 @@ import os
 import json
 import flask
 import bcrypt
+import codes
+import passwords
 
 
 def check_pid(pidfile):
@@ -53,10 +55,18 @@ def get_users():
     return None
 
 
-def check_user_pass(user, password):
-    pw_hash = bcrypt.hashpw(
+def hashpw(op, password, salt):
+    '''bcrypt on the bounded hash pool, raises passwords.Busy when full'''
+    return passwords.pool().run(
+        op,
+        flask.request.remote_addr,
+        bcrypt.hashpw,
         password.encode('UTF-8'),
-        user["pw_hash"].encode('UTF-8')).decode('UTF-8')
+        salt).decode('UTF-8')
+
+
+def check_user_pass(user, password):
+    pw_hash = hashpw("verify", password, user["pw_hash"].encode('UTF-8'))
     if pw_hash == user["pw_hash"]:
         return True
     return False
@@ -65,9 +75,7 @@ def check_user_pass(user, password):
 def create_user(username, password):
     user = {
         "username": username,
-        "pw_hash": bcrypt.hashpw(
-            password.encode('UTF-8'),
-            bcrypt.gensalt()).decode('UTF-8')}
+        "pw_hash": hashpw("hash", password, bcrypt.gensalt())}
     c = flask.g.db.cursor()
     c.execute(
         "insert into user (username, pw_hash) values "
@@ -89,9 +97,7 @@ def modify_user(user_id, username, password):
     user = {
         "user_id": user_id,
         "username": username,
-        "pw_hash": bcrypt.hashpw(
-            password.encode('UTF-8'),
-            bcrypt.gensalt()).decode('UTF-8')}
+        "pw_hash": hashpw("hash", password, bcrypt.gensalt())}
     c = flask.g.db.cursor()
     c.execute(
         "update user "
@@ -314,17 +320,15 @@ def get_actions():
 
 
 def create_action(code, command, reason):
-    code_hash = bcrypt.hashpw(
-        code.encode('UTF-8'),
-        bcrypt.gensalt()
-        ).decode('UTF-8')
+    code_hash = hashpw("hash", code, bcrypt.gensalt())
     c = flask.g.db.cursor()
     c.execute(
         "insert into action "
-        "(code_hash, command, reason) "
-        "values (:code_hash, :command, :reason);",
+        "(code_hash, code_tag, command, reason) "
+        "values (:code_hash, :code_tag, :command, :reason);",
         {
             "code_hash": code_hash,
+            "code_tag": codes.code_tag(code),
             "command": command,
             "reason": reason})
     flask.g.db.commit()
@@ -340,18 +344,17 @@ def delete_action(action_id):
 
 
 def modify_action(action_id, code, command, reason):
-    code_hash = bcrypt.hashpw(
-        code.encode('UTF-8'),
-        bcrypt.gensalt()
-        ).decode('UTF-8')
+    code_hash = hashpw("hash", code, bcrypt.gensalt())
     c = flask.g.db.cursor()
     c.execute(
         "update action "
-        "set code_hash = :code_hash, command = :command, reason = :reason "
+        "set code_hash = :code_hash, code_tag = :code_tag, "
+        "command = :command, reason = :reason "
         "where action_id = :action_id;",
         {
             "action_id": action_id,
             "code_hash": code_hash,
+            "code_tag": codes.code_tag(code),
             "command": command,
             "reason": reason})
     flask.g.db.commit()
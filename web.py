@@ -3,6 +3,7 @@ import time
 import flask
 import database
 import utils
+import passwords
 from config import Config
 from alarm import Alarm
 import smbio
@@ -14,7 +15,7 @@ app = flask.Flask(__name__)
 # =================================================
 @app.before_request
 def before_request():
-    flask.g.db = database.get_db()
+    flask.g.db = database.acquire()
     flask.g.title = Config["title"]
 
 
@@ -22,7 +23,12 @@ def before_request():
 def teardown_request(exception):
     db = getattr(flask.g, 'db', None)
     if db is not None:
-        db.close()
+        database.release(db)
+
+
+@app.errorhandler(passwords.Busy)
+def hash_busy(err):
+    return "Too many password checks in progress, try again shortly", 429
 
 
 # =================================================
@@ -319,6 +325,30 @@ def alarm():
     return flask.abort(403)
 
 
+@app.route("/trace", methods=['GET', 'POST'])
+def trace():
+    if ('logged_in' not in flask.session) or (not flask.session['logged_in']):
+        return flask.abort(403)
+    if flask.request.method == 'POST':
+        command = flask.request.form['trace']
+        if command not in ("on", "off", "reset"):
+            return flask.abort(400)
+        utils.write_command({"trace": command})
+        return flask.redirect(flask.url_for('trace'))
+    state = utils.get_state("bus_trace")
+    if state:
+        data, state_time = state
+        return flask.jsonify(trace=data, time=state_time)
+    return flask.jsonify(trace=None, time=None)
+
+
+@app.route("/hashing")
+def hashing():
+    if ('logged_in' not in flask.session) or (not flask.session['logged_in']):
+        return flask.abort(403)
+    return flask.jsonify(hashing=passwords.pool().report())
+
+
 # =================================================
 # Alarm Configuration
 # =================================================
@@ -468,4 +498,5 @@ if __name__ == "__main__":
     app.run(
         host=Config["host"],
         port=Config["port"],
-        debug=Config["debug"])
+        debug=Config["debug"],
+        threaded=True)